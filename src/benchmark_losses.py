@@ -0,0 +1,65 @@
+"""
+    point cloud and semi_opt losses, forward + backward time, run from src/ :
+        python benchmark_losses.py -b 8 -N 1024 4096 --lpips
+"""
+import time
+import argparse
+import torch
+from vae.ops import POINT_CLOUD_LOSSES, point_cloud_loss
+from utils.semi_loss import semi_opt
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-b', '--batch_size', type=int, default=8, help='Clouds per batch')
+parser.add_argument('-N', '--num_points', type=int, nargs='+', default=[1024, 4096],
+                    help='Points per cloud')
+parser.add_argument('-l', '--losses', type=str, nargs='+', default=POINT_CLOUD_LOSSES,
+                    help='Point cloud losses to time')
+parser.add_argument('--exact_max', type=int, default=2048,
+                    help='Skip emd_exact above this many points, the assignment is cubic')
+parser.add_argument('-k', '--n_projections', type=int, default=50, help='sliced-Wasserstein directions')
+parser.add_argument('-s', '--steps', type=int, default=3, help='Timed calls')
+parser.add_argument('--lpips', action='store_true', help='Also time semi_opt with the LPIPS cost (downloads alexnet)')
+args = parser.parse_args()
+torch.manual_seed(1)
+
+
+def time_it(fn):
+    fn()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        fn()
+    return (time.perf_counter() - start) / args.steps
+
+
+def backward(loss_fn, *inputs):
+    def step():
+        loss = loss_fn(*inputs)
+        loss.sum().backward()
+        return loss
+    return step
+
+
+for n in args.num_points:
+    x = torch.rand(args.batch_size, n, 3, requires_grad=True)
+    y = torch.rand(args.batch_size, n, 3, requires_grad=True)
+    for name in args.losses:
+        if name == 'emd_exact' and n > args.exact_max:
+            continue
+        loss_fn = point_cloud_loss(name, args.n_projections)
+        secs = time_it(backward(loss_fn, x, y))
+        with torch.no_grad():
+            value = loss_fn(x, y).mean().item()
+        print('points {:6d} {:16s} {:10.2f} ms  value {:.5f}'.format(n, name, secs * 1e3, value))
+
+# semi_opt on 2 x 64 MNIST-sized images, as in demo_pixelcnn.py
+nu_data = torch.rand(64, 1, 28, 28) * 2 - 1
+mu_data = torch.rand(128, 1, 28, 28) * 2 - 1
+px = torch.rand(128, requires_grad=True)
+costs = [('sliced', None)]
+if args.lpips:
+    from perceptual_loss import models
+    costs += [('lpips', models.PerceptualLoss(model='net-lin', net='alex', use_gpu=False))]
+for cost, loss_fn in costs:
+    secs = time_it(backward(lambda p: semi_opt(nu_data, mu_data, p, loss_fn, cost=cost,
+                                               n_projections=args.n_projections), px))
+    print('semi_opt {:10s} {:10.2f} ms'.format(cost, secs * 1e3))
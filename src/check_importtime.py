@@ -0,0 +1,59 @@
+"""
+    import-time regression check of the training entry points, run from src/ :
+        python check_importtime.py --budget 3.0
+    every module is imported in a fresh interpreter under python -X importtime. the check fails
+    when a module pulls in one of the DEFERRED dependencies at import, or when its cumulative
+    import time exceeds the budget. importing init creates the result directories of configs
+"""
+import sys
+import argparse
+import subprocess
+
+ENTRY_POINTS = ['pixelcnnpp.model', 'pixelcnnpp.model_latent', 'pixelcnnpp.utils',
+                'pixelcnnpp.data', 'pixelcnnpp.checkpoint', 'vae.ops', 'vae.latent_cache',
+                'utils.semi_loss', 'utils.provider', 'utils.helper', 'utils.render',
+                'perceptual_loss.models', 'init']
+# imported by the functions that need them, never by importing a training module
+DEFERRED = ['skimage', 'IPython', 'ot', 'matplotlib', 'pymorton', 'sklearn',
+            'torch.utils.tensorboard']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-b', '--budget', type=float, default=3.0,
+                    help='Maximum cumulative import time of an entry point, in seconds')
+parser.add_argument('-m', '--modules', type=str, nargs='+', default=ENTRY_POINTS,
+                    help='Entry points to check')
+args = parser.parse_args()
+
+
+def import_times(module):
+    """ {imported module: cumulative seconds} of a cold import of module """
+    run = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                         stderr=subprocess.PIPE, universal_newlines=True)
+    if run.returncode != 0:
+        raise Exception('import {} failed :\n{}'.format(module, run.stderr[-2000:]))
+    times = {}
+    for line in run.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) * 1e-6
+    return times
+
+
+failures = []
+for module in args.modules:
+    times = import_times(module)
+    seconds = times.get(module, 0.)
+    heavy = sorted(set(d for d in DEFERRED for name in times if name == d or name.startswith(d + '.')))
+    status = 'ok'
+    if heavy:
+        status = 'imports ' + ', '.join(heavy)
+    elif seconds > args.budget:
+        status = 'over budget'
+    if status != 'ok':
+        failures += [module]
+    print('{:28s} {:7.3f} s  {}'.format(module, seconds, status))
+
+if failures:
+    print('import-time check failed : {}'.format(', '.join(failures)))
+    sys.exit(1)
@@ -28,6 +28,12 @@ parser.add_argument('--seed', type=int, default=1,
                     help='Random seed to use')
 parser.add_argument('--log_step', type=int, default=10, help='step size for prining log info')
 parser.add_argument('--save_step', type=int, default=50, help='step size for saving trained models')
+parser.add_argument('--ckpt_every', type=int, default=0, help='steps between full training checkpoints, 0 = end of epoch only')
+parser.add_argument('--ckpt_minutes', type=float, default=0., help='minutes between full training checkpoints, 0 = never')
+parser.add_argument('--ckpt_keep', type=int, default=3, help='number of full training checkpoints to keep, at least 1')
+parser.add_argument('--semi_cost', type=str, default='lpips', choices=['lpips', 'sliced'], help='semi_opt cost: lpips ground cost or sliced-Wasserstein')
+parser.add_argument('--ae_loss', type=str, default='emd', help='point cloud reconstruction loss, see vae.ops.POINT_CLOUD_LOSSES')
+parser.add_argument('--n_projections', type=int, default=50, help='random directions of the sliced-Wasserstein distance')
 
 parser.add_argument('--flag_retrain', default=False, action='store_true', help='Re train')
 parser.add_argument('--flag_reg', default=False, action='store_true', help='Regularizer')
@@ -61,6 +67,12 @@ parser.add_argument('--nr_filters', type=int, default=50,
                     help='Number of filters to use across the model. Higher = larger model.')
 parser.add_argument('--nr_logistic_mix', type=int, default=10,
                     help='Number of logistic components in the mixture. Higher = more flexible model')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                    help='Precision policy: bf16 runs the PixelCNN convolutions in bfloat16, losses stay float32')
+parser.add_argument('--channels_last', default=False, action='store_true',
+                    help='Run the PixelCNN in channels_last (NHWC) memory format')
+parser.add_argument('--grad_checkpoint', default=False, action='store_true',
+                    help='Recompute PixelCNN gated_resnet internals in backward to save memory')
 
 # Model parameters
 args = parser.parse_args()
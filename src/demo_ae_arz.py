@@ -10,6 +10,8 @@ from pixelcnnpp.model import *
 from pixelcnnpp.utils import *
 
 from vae.ops import *
+from vae.latent_cache import cache_latent_codes
+from utils.provider import PointCloudDataset
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -23,7 +25,9 @@ input_channels = obs[0]
 netV = PointCloudAutoEncoder(size=1024, dim=3, name=args.model_name, enc_size=64,
 		batch_size=args.batch_size).to(device)
 netA = PixelCNN(nr_resnet=args.nr_resnet, nr_filters=args.nr_filters,
-			input_channels=input_channels, nr_logistic_mix=args.nr_logistic_mix).to(device)
+			input_channels=input_channels, nr_logistic_mix=args.nr_logistic_mix,
+			precision=args.precision, channels_last=args.channels_last,
+			grad_checkpoint=args.grad_checkpoint).to(device)
 
 # netV.apply(Helper.weights_init)
 netA.apply(Helper.weights_init)
@@ -43,31 +47,35 @@ optimizerA = optim.Adam(netA.parameters(), lr=args.lr, betas=(0.5, 0.9))
 netV_path = os.path.join(model_path, 'vnet.pth')
 netA_path = os.path.join(model_path, 'anet.pth')
 
-loss_fn = EmdDistance()
+loss_fn = point_cloud_loss(args.ae_loss, args.n_projections)
 loss_op   = lambda real, fake : discretized_mix_logistic_loss_1d(real, fake)
 sample_op = lambda x : sample_from_discretized_mix_logistic_1d(x, args.nr_logistic_mix)
 
 # ==================Data======================
-trainset=Provider.load_data(dataset_path, args.mode_space, space_dim, num_hiters,
-							normalized = True, renew = args.flag_renew_data)
-# [N, 32, 32, 3]
-trainset = SFC.convert1dto2d(trainset)
-trainset = torch.Tensor(trainset)
-N = trainset.shape[0]
-trainset = trainset.permute(0, 3, 2, 1).contiguous().view(N, 3, 1024)
-dataloader = DataLoader(trainset, batch_size = args.batch_size,
-						shuffle = True, drop_last = True)
+# the [N, 32, 32, 3] grid of SFC.convert1dto2d read back column by column is a fixed reordering
+# of the 1024 points : grid_order[j * 32 + i] is the point placed in cell (i, j)
+grid_order = SFC.convert1dto2d(np.arange(1024).reshape(1, 1024, 1).repeat(3, axis=2))
+grid_order = torch.from_numpy(grid_order[0, :, :, 0].T.reshape(-1).astype(np.int64))
+# memory-mapped, batches [B, 3, 1024] are read and reordered on demand
+trainset = Provider.load_dataset(dataset_path, args.mode_space, space_dim, num_hiters,
+							renew = args.flag_renew_data,
+							transform = lambda x: x[:, grid_order, :].permute(0, 2, 1).contiguous())
+dataloader = trainset.loader(args.batch_size, shuffle = True, drop_last = True)
 
 # ==================Training======================
 def sample(model, nsamples=2):
 	model.train(False)
+	model.fold_weight_norm()
 	data = torch.zeros(nsamples, obs[0], obs[1], obs[2]).to(device)
-	for i in range(obs[1]):
-		for j in range(obs[2]):
-			with torch.no_grad():
-				out = model(data, sample=True)
-				out_sample = sample_op(out)
-				data[:, :, i, j] = out_sample.data[:, :, i, j]
+	try:
+		for i in range(obs[1]):
+			for j in range(obs[2]):
+				with torch.no_grad():
+					out = model(data, sample=True)
+					out_sample = sample_op(out)
+					data[:, :, i, j] = out_sample.data[:, :, i, j]
+	finally:
+		model.unfold_weight_norm()
 	return data
 
 def plot_pc(samples, epoch, name, nsamples=1, color=False):
@@ -78,14 +86,18 @@ def plot_pc(samples, epoch, name, nsamples=1, color=False):
 	for i in range(nsamples):
 		img = samples[i, :, :]
 		filepath = sample_path + '/{}_{}_{}.png'.format(epoch, i, name)
-		if color:
-			Plotter.plot_pc_color(img, filepath)
-		else:
-			Plotter.plot_pc(img, filepath)
+		renderer.plot_pc(img, filepath, color=color)
 
 
 print('Load AE')
 netV.load_state_dict(torch.load(netV_path))
+# netV is frozen : its codes are computed once per AE checkpoint and streamed from disk.
+# eval mode, so batchnorm encodes (and decodes samples) with its running statistics and the
+# codes do not depend on the batch. before the cache, netV ran in train mode with batch statistics
+netV.eval()
+codes_path = cache_latent_codes(netV.encode, trainset.loader(args.batch_size, shuffle=False, drop_last=False),
+							device, model_path, netV_path, renew=args.flag_renew_data)
+code_loader = PointCloudDataset(codes_path).loader(args.batch_size, shuffle=True, drop_last=True)
 
 start_time = time.time()
 if os.path.isfile(netA_path) and args.flag_retrain:
@@ -94,11 +106,9 @@ if os.path.isfile(netA_path) and args.flag_retrain:
 
 total_step = len(trainset) // args.batch_size
 for epoch in range(args.num_epochs):
-	for batch_idx, batch_data in enumerate(dataloader):
+	for batch_idx, z in enumerate(code_loader):
 		optimizerA.zero_grad()
-		batch_data = batch_data.to(device)
-		z = netV.encode(batch_data).detach()
-		z = z.view(args.batch_size, 8, 8).unsqueeze(1)
+		z = z.to(device).view(args.batch_size, 8, 8).unsqueeze(1)
 		out_params = netA(z)
 		loss = loss_op(z, out_params).mean()
 		loss.backward()
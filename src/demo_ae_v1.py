@@ -7,7 +7,6 @@
 from vae.model_ae import AE
 from vae.ops import *
 from gan.ops import log_loss_gan
-from vae.EMD.emd import EmdDistance
 from _init_ import *
 # ==================Model======================
 # MODEL-VAE
@@ -18,7 +17,7 @@ netV.apply(Helper.weights_init)
 optimizerV = optim.Adam(netV.parameters(), lr=args.lr, betas=(0.5, 0.9))
 netV_path = os.path.join(model_path, 'vnet.pth')
 
-loss_fn = EmdDistance()
+loss_fn = point_cloud_loss(args.ae_loss, args.n_projections)
 
 def plot_pc(samples, epoch, name, nsamples=1, color=False):
 	# samples = samples.permute(0, 2, 1)
@@ -28,18 +27,14 @@ def plot_pc(samples, epoch, name, nsamples=1, color=False):
 	for i in range(nsamples):
 		img = samples[i, :, :]
 		filepath = sample_path + '/{}_{}_{}.png'.format(epoch, i, name)
-		if color:
-			Plotter.plot_pc_color(img, filepath)
-		else:
-			Plotter.plot_pc(img, filepath)
+		renderer.plot_pc(img, filepath, color=color)
 # ==================Training======================
 
-trainset = Provider.load_data(dataset_path, args.mode_space, space_dim, num_hiters,
-							normalized = True, renew = args.flag_renew_data)
-trainset = torch.Tensor(trainset)
-trainset = trainset.permute(0, 2, 1)
-dataloader = DataLoader(trainset, batch_size = args.batch_size,
-						shuffle = True, drop_last = True)
+# memory-mapped, batches [B, 3, num_points] are read on demand
+trainset = Provider.load_dataset(dataset_path, args.mode_space, space_dim, num_hiters,
+							renew = args.flag_renew_data,
+							transform = lambda x: x.permute(0, 2, 1).contiguous())
+dataloader = trainset.loader(args.batch_size, shuffle = True, drop_last = True)
 
 start_time = time.time()
 if os.path.isfile(net_path) and args.flag_retrain:
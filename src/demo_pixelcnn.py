@@ -14,6 +14,8 @@
 
 from pixelcnnpp.model import *
 from pixelcnnpp.utils import *
+from pixelcnnpp.checkpoint import CheckpointManager, ResumableSampler, AsyncWriter, to_cpu
+from pixelcnnpp.data import load_uint8, make_loader, Prefetcher
 from utils.semi_loss import semi_opt
 # load all common variables and constants
 from init import *
@@ -26,7 +28,9 @@ out_dim = obs[0] * args.nr_logistic_mix * 3 # number of outputs, 3 is for 3 para
 # PixelCNN network
 net = PixelCNN(nr_resnet=args.nr_resnet,
 				nr_filters=args.nr_filters,
-				input_channels=input_channels, nr_logistic_mix=args.nr_logistic_mix).to(device)
+				input_channels=input_channels, nr_logistic_mix=args.nr_logistic_mix,
+				precision=args.precision, channels_last=args.channels_last,
+				grad_checkpoint=args.grad_checkpoint).to(device)
 net.apply(Helper.weights_init)
 
 # optimization with cyclic scheduler
@@ -42,19 +46,22 @@ density_op = lambda x, params: discretized_mix_logistic_density_1d(x, params)
 
 # path to store the trained model
 net_path = os.path.join(model_path, 'net.pth')
+# models and samples are written by a background thread
+io_writer = AsyncWriter(max_pending=2)
+# full training states (net, optimizer, scheduler, rng, step) to resume from
+checkpoints = CheckpointManager(model_path, prefix='net_ckpt', keep=args.ckpt_keep,
+				every_steps=args.ckpt_every, every_minutes=args.ckpt_minutes, writer=io_writer)
 
 # ==================Data======================
-# scale data into [-1, 1] which is the support of logistic distribution
-rescaling     = lambda x : (x - .5) * 2.
+# data is scaled into [-1, 1], the support of logistic distribution, by the prefetcher
 rescaling_inv = lambda x : .5 * x  + .5
-kwargs = {'num_workers':1, 'pin_memory':True, 'drop_last':True}
-ds_transforms = transforms.Compose([transforms.ToTensor(), rescaling])
-# load dataset with transforms
-dataloader = torch.utils.data.DataLoader(
-						datasets.MNIST(dataset_path, download=True, train=True,  transform=ds_transforms),
-							batch_size=args.batch_size,
-                            shuffle=True,
-							**kwargs)
+# uint8 images decoded once into shared memory, the sampler replays an interrupted epoch when resuming
+train_images, train_labels = load_uint8('mnist', dataset_path, train=True)
+train_sampler = ResumableSampler(train_images, seed=args.seed)
+dataloader = Prefetcher(make_loader(train_images, train_labels, args.batch_size,
+							sampler=train_sampler, drop_last=True,
+							pin_memory=device.type == 'cuda',
+							generator=torch.Generator().manual_seed(args.seed)), device)
 # test_loader  = torch.utils.data.DataLoader(datasets.MNIST(dataset_path, train=False,
                 # transform=ds_transforms), batch_size=args.batch_size, shuffle=True, **kwargs)
 
@@ -97,14 +104,19 @@ def generate_sample(model, obs, sample_batch_size=10, training=False):
 torch.manual_seed(args.seed)
 np.random.seed(args.seed)
 start_time = time.time()
+global_step = 0
+start_epoch, start_batch = 0, 0
 # load the existed model if flag_retrain is True
-if os.path.isfile(net_path) and args.flag_retrain:
+if args.flag_retrain and checkpoints.latest() is not None:
+	print('Resume training')
+	global_step, counters = checkpoints.load(checkpoints.latest(), net, optimizer, scheduler)
+	start_epoch, start_batch = counters['epoch'], counters['batches']
+elif os.path.isfile(net_path) and args.flag_retrain:
 	print('Load existing models')
 	net.load_state_dict(torch.load(net_path))
 
 # for printing total_step only
-data_iter = iter(dataloader)
-total_step = len(data_iter)
+total_step = len(dataloader)
 
 """
 	Flow: we measure the divergence between 2 distributions: (1) (continuous) learned paramterized-net distributions and (2) (discrete) sample distribution of image
@@ -112,11 +124,12 @@ total_step = len(data_iter)
 	- semi_opt is the semi-loss in the paper
 """
 num_source_samples = 2 * args.batch_size #number of samples representing source distributions
-for epoch in range(args.num_epochs):
+for epoch in range(start_epoch, args.num_epochs):
 	lossfs = [] # list of all loss values by epoch
 	net.train(True)
-	torch.cuda.synchronize()
-	for batch_idx, (batch_data, _) in enumerate(dataloader):
+	train_sampler.set_epoch(epoch, start_batch * args.batch_size)
+	if device.type == 'cuda': torch.cuda.synchronize()
+	for batch_idx, (batch_data, _) in enumerate(dataloader, start_batch):
 		optimizer.zero_grad()
 		batch_data = batch_data.to(device) # [N, C, H, W]
 		# out_params = net(batch_data)
@@ -132,11 +145,13 @@ for epoch in range(args.num_epochs):
 		log_px = density_op(sample_t, out_params).sum(dim=[1, 2])
 		px = torch.exp(log_px)
 		# calculate semi loss: []
-		loss = semi_opt(batch_data, sample_t, px, loss_fn)
+		loss = semi_opt(batch_data, sample_t, px, loss_fn, cost=args.semi_cost,
+						n_projections=args.n_projections)
 
 		loss.backward()
 		lossfs.append(loss.data.item())
 		optimizer.step()
+		global_step += 1
 
 		# Print log info
 		if 0 == batch_idx % args.log_step:
@@ -144,9 +159,13 @@ for epoch in range(args.num_epochs):
 			start_time = time.time()
 			print('loss: {:.4f}'.format(np.mean(lossfs)))
 
+		if checkpoints.due(global_step):
+			checkpoints.save(global_step, net, optimizer, scheduler, epoch=epoch, batches=batch_idx + 1)
+	start_batch = 0
+
 	# store  model
 	print('save models at epoch')
-	torch.save(net.state_dict(), net_path)
+	io_writer.submit(torch.save, to_cpu(net.state_dict()), net_path)
 	# write to tensorboard
 	writer.add_scalar('train/loss', np.mean(lossfs), epoch)
 	# decrease learning rate
@@ -155,7 +174,7 @@ for epoch in range(args.num_epochs):
 	# generate samples for testing
 	if 0 == (epoch + 1) % args.save_step:
 		print('sampling')
-		torch.cuda.synchronize()
+		if device.type == 'cuda': torch.cuda.synchronize()
 		net.eval()
 		# sample_t: []
 		sample_t = generate_sample(net, obs, sample_batch_size=2)
@@ -163,7 +182,13 @@ for epoch in range(args.num_epochs):
 		sample_t = rescaling_inv(sample_t)
 		# pick 2 images for saving
 		real_t = rescaling_inv(batch_data[:2, :, :, :])
-		torchvision.utils.save_image(sample_t,
+		io_writer.submit(torchvision.utils.save_image, to_cpu(sample_t),
 					os.path.join(sample_path, 'sample_{}.png'.format(epoch)),
                 	nrow=5, padding=0)
+
+	# after sampling, which draws from the rng, so that a resumed run continues the same stream
+	checkpoints.save(global_step, net, optimizer, scheduler, epoch=epoch + 1, batches=0)
 writer.close()
+io_writer.close()
+print('background writes: {writes}, mean {write_mean:.3f}s, max {write_max:.3f}s, blocked {submit_wait_total:.3f}s'.format(
+	**io_writer.stats()))
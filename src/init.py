@@ -15,14 +15,37 @@ import torch.autograd as autograd
 import torch.optim as optim
 from torch.optim import lr_scheduler
 from torch.utils.data import DataLoader
-from torch.utils.tensorboard import SummaryWriter
 from torchvision import datasets, transforms, utils
 
-from perceptual_loss import models
 from configs import args
 from utils.helper import Helper
 from utils.provider import Provider
-from utils.plotter import Plotter
+from utils.render import Renderer
+
+class Lazy(object):
+	"""
+		stands for the object factory() returns, built on the first attribute access or call, so
+		importing this module costs nothing for the resources a script never uses.
+		close() does nothing when the object was never built
+	"""
+	def __init__(self, factory):
+		self._factory = factory
+		self._obj = None
+
+	def get(self):
+		if self._obj is None:
+			self._obj = self._factory()
+		return self._obj
+
+	def __getattr__(self, name):
+		return getattr(self.get(), name)
+
+	def __call__(self, *args, **kwargs):
+		return self.get()(*args, **kwargs)
+
+	def close(self):
+		if self._obj is not None:
+			self._obj.close()
 
 # CONSTANTS ######################3
 # name, space dim, number of points
@@ -42,14 +65,29 @@ Helper.mkdir(args.result_path)
 Helper.mkdir(output_path)
 Helper.mkdir(model_path)
 Helper.mkdir(sample_path)
-logf=open(log_path, 'w')
-Helper.mkdir(writer_path, rm=True)
-writer=SummaryWriter(comment = model_name, log_dir = writer_path)
+logf=Lazy(lambda: open(log_path, 'w'))
+
+def make_writer():
+	from torch.utils.tensorboard import SummaryWriter
+	# a fresh tensorboard run, wiped when the first scalar is written rather than at import
+	Helper.mkdir(writer_path, rm=True)
+	return SummaryWriter(comment = model_name, log_dir = writer_path)
+
+writer=Lazy(make_writer)
 
 #####====================== Data ================######
 device=Helper.__device__
 
-loss_fn = models.PerceptualLoss(model='net-lin', net='alex', use_gpu=True, gpu_ids=[0])
+def make_perceptual_loss():
+	from perceptual_loss import models
+	return models.PerceptualLoss(model='net-lin', net='alex', use_gpu=True, gpu_ids=[0])
+
+# LPIPS (alexnet weights, moved to the gpu) is only built by the scripts that use it
+loss_fn = Lazy(make_perceptual_loss)
+
+# sample plots are rendered and written by a process pool, off the training loop. built at
+# import, before the scripts start any thread, since the pool is forked
+renderer = Renderer()
 
 ####====== Modules =======####
 def log_loss(epoch, step, total_step, loss, start_time):
@@ -75,12 +113,10 @@ def plot_step(sample):
 	# sample = sample.permute(2, 1, 0)
 	# sample = sample.contiguous().view(1024, 3)
 	# sample = sample.cpu().data.numpy()
-	# plot
-	for i in range(1024):
-		img = sample[:i+1, :]
-		filepath = sample_path + '/step_{:04d}.png'.format(i)
-		Plotter.plot_pc_color(img, filepath)
-		print(i)
+	# plot: one image per prefix of the 1024 points, spread over the render pool
+	if torch.is_tensor(sample):
+		sample = sample.detach().cpu().numpy()
+	renderer.plot_pc_steps(sample[:1024], sample_path + '/step_{:04d}.png')
 
 def plot_samples(samples, epoch, name, nsamples=1, color=False):
 	# reshape [N, C, H, W] -> [N, W, H, C]
@@ -91,7 +127,4 @@ def plot_samples(samples, epoch, name, nsamples=1, color=False):
 	for i in range(nsamples):
 		img = samples[i, :, :]
 		filepath = sample_path + '/{}_{}_{}.png'.format(name, epoch, i)
-		if color:
-			Plotter.plot_pc_color(img, filepath)
-		else:
-			Plotter.plot_pc(img, filepath)
+		renderer.plot_pc(img, filepath, color=color)
@@ -4,7 +4,6 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
-from skimage.measure import compare_ssim
 import torch
 from torch.autograd import Variable
 
@@ -51,6 +50,7 @@ def psnr(p0, p1, peak=255.):
     return 10*np.log10(peak**2/np.mean((1.*p0-1.*p1)**2))
 
 def dssim(p0, p1, range=255.):
+    from skimage.measure import compare_ssim
     return (1 - compare_ssim(p0, p1, data_range=range, multichannel=True)) / 2.
 
 def rgb2lab(in_img,mean_cent=False):
@@ -2,7 +2,6 @@ import os
 import torch
 from torch.autograd import Variable
 from pdb import set_trace as st
-from IPython import embed
 
 class BaseModel():
     def __init__(self):
@@ -10,10 +10,8 @@ from collections import OrderedDict
 from torch.autograd import Variable
 import itertools
 from .base_model import BaseModel
-from scipy.ndimage import zoom
 import fractions
 import functools
-import skimage.transform
 from tqdm import tqdm
 
 from . import networks_basic as networks
@@ -177,6 +175,7 @@ class DistModel(BaseModel):
         return retDict
 
     def get_current_visuals(self):
+        from scipy.ndimage import zoom
         zoom_factor = 256/self.var_ref.data.size()[2]
 
         ref_img = util.tensor2im(self.var_ref.data)
@@ -8,8 +8,6 @@ import torch.nn.init as init
 from torch.autograd import Variable
 import numpy as np
 from pdb import set_trace as st
-from skimage import color
-from IPython import embed
 from . import pretrained_networks as pn
 
 # import models as util
@@ -0,0 +1,118 @@
+"""
+    eager vs compiled PixelCNN throughput on CPU, run from src/ :
+        python -m pixelcnnpp.benchmark -q 5 -n 160 -b 16
+    --stacks only times forward + backward of the full resolution up and down stacks
+"""
+import sys
+import time
+import argparse
+import torch
+import torch.optim as optim
+from .model import PixelCNN
+from .utils import *
+from .export import compile_model, export_torchscript
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--dataset', type=str, default='cifar', help='Can be either cifar|mnist')
+parser.add_argument('-q', '--nr_resnet', type=int, default=4,
+                    help='Number of residual blocks per stage of the model')
+parser.add_argument('-n', '--nr_filters', type=int, default=80,
+                    help='Number of filters to use across the model')
+parser.add_argument('-m', '--nr_logistic_mix', type=int, default=10,
+                    help='Number of logistic components in the mixture')
+parser.add_argument('-b', '--batch_size', type=int, default=16, help='Batch size of a training step')
+parser.add_argument('-B', '--sample_batch_size', type=int, default=25,
+                    help='Batch size of a sampling step')
+parser.add_argument('-w', '--warmup', type=int, default=3, help='Untimed steps (includes compilation)')
+parser.add_argument('-k', '--steps', type=int, default=10, help='Timed steps')
+parser.add_argument('-j', '--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+parser.add_argument('--compile_mode', type=str, default='default', help='torch.compile mode')
+parser.add_argument('--stacks', action='store_true',
+                    help='Only time the full resolution up and down stacks, forward + backward')
+args = parser.parse_args()
+
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+torch.manual_seed(1)
+
+obs = (1, 28, 28) if 'mnist' in args.dataset else (3, 32, 32)
+if 'mnist' in args.dataset :
+    loss_op   = lambda real, fake : discretized_mix_logistic_loss_1d(real, fake)
+    sample_op = lambda x : sample_from_discretized_mix_logistic_1d(x, args.nr_logistic_mix)
+else :
+    loss_op   = lambda real, fake : discretized_mix_logistic_loss(real, fake).sum()
+    sample_op = lambda x : sample_from_discretized_mix_logistic(x, args.nr_logistic_mix)
+
+model = PixelCNN(nr_resnet=args.nr_resnet, nr_filters=args.nr_filters,
+            input_channels=obs[0], nr_logistic_mix=args.nr_logistic_mix)
+optimizer = optim.Adam(model.parameters(), lr=2e-4)
+batch = torch.empty(args.batch_size, *obs).uniform_(-1., 1.)
+data = torch.zeros(args.sample_batch_size, *obs)
+
+
+def time_it(fn):
+    for _ in range(args.warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        fn()
+    return (time.perf_counter() - start) / args.steps
+
+
+def train_step(net):
+    def step():
+        output = net(batch)
+        loss = loss_op(batch, output)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return step
+
+
+def sample_step(net):
+    def step():
+        # the sample flag no longer changes the forward pass, positional call fits the traced module too
+        with torch.no_grad():
+            sample_op(net(data))
+    return step
+
+
+def stack_step(layer, *inputs):
+    def step():
+        outputs = layer(*inputs)
+        flat = [y for out in outputs for y in (out if isinstance(out, list) else [out])]
+        sum(y.sum() for y in flat).backward()
+    return step
+
+
+if args.stacks:
+    model.train()
+    shape = (args.batch_size, args.nr_filters) + obs[1:]
+    u, ul = [torch.randn(shape, requires_grad=True) for _ in range(2)]
+    up, down = model.up_layers[0], model.down_layers[2]
+    skips = [[torch.randn(shape) for _ in range(down.nr_resnet)] for _ in range(2)]
+    for name, step in [('up stack', stack_step(up, u, ul)),
+                       ('down stack', stack_step(down, u, ul, *skips))]:
+        secs = time_it(step)
+        print('{:12s} {:9.2f} ms  {:9.1f} images/s'.format(name, secs * 1e3, args.batch_size / secs))
+    sys.exit(0)
+
+results = []
+model.train()
+results += [('train step', 'eager', time_it(train_step(model)))]
+results += [('train step', 'compiled', time_it(train_step(compile_model(model, mode=args.compile_mode))))]
+
+model.eval()
+results += [('sample step', 'eager', time_it(sample_step(model)))]
+model.fold_weight_norm()
+results += [('sample step', 'eager, folded', time_it(sample_step(model)))]
+results += [('sample step', 'compiled, folded',
+             time_it(sample_step(compile_model(model, mode=args.compile_mode))))]
+model.unfold_weight_norm()
+results += [('sample step', 'torchscript', time_it(sample_step(export_torchscript(model, data))))]
+
+print('{} threads, nr_resnet {}, nr_filters {}'.format(torch.get_num_threads(), args.nr_resnet,
+                                                       args.nr_filters))
+for name, mode, secs in results:
+    n = args.batch_size if name == 'train step' else args.sample_batch_size
+    print('{:12s} {:18s} {:9.2f} ms  {:9.1f} images/s'.format(name, mode, secs * 1e3, n / secs))
@@ -0,0 +1,206 @@
+import os
+import glob
+import time
+import queue
+import atexit
+import random
+import threading
+import numpy as np
+import torch
+
+
+def get_rng_state():
+    """ every random number generator a training step may draw from """
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(),
+             'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def to_cpu(obj):
+    """ detached cpu copies of every tensor in a (nested) state, safe to serialise while training
+        keeps updating the originals in place """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+class AsyncWriter(object):
+    """ runs serialisation and disk i/o (torch.save, save_image, ...) on a background thread.
+        submit blocks once max_pending writes are queued, so a slow disk throttles training instead
+        of piling up snapshots in memory. close (also run at exit) waits for every queued write,
+        an exception raised by a write is re-raised by the next submit or close """
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.latencies = []
+        self.waits = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            fn, args, kwargs = job
+            start = time.perf_counter()
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                self.error = e
+            self.latencies.append(time.perf_counter() - start)
+            self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn, *args, **kwargs):
+        """ args must already be snapshots (see to_cpu), they are used after submit returns """
+        self.check()
+        if not self.thread.is_alive():
+            raise Exception('AsyncWriter is closed')
+        start = time.perf_counter()
+        self.queue.put((fn, args, kwargs))
+        self.waits.append(time.perf_counter() - start)
+
+    def flush(self):
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+
+    def stats(self):
+        """ seconds spent writing in the background and blocked in submit by the training loop """
+        n = len(self.latencies)
+        return {'writes': n,
+                'write_mean': sum(self.latencies) / n if n > 0 else 0.,
+                'write_max': max(self.latencies) if n > 0 else 0.,
+                'submit_wait_total': sum(self.waits)}
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """ shuffles with a generator seeded by (seed, epoch), so the order of any epoch can be
+        replayed, and shards it over num_replicas processes like DistributedSampler.
+        set_epoch(epoch, start) skips the first start samples of this process when resuming """
+    def __init__(self, data_source, seed=0, shuffle=True, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # padded so that every process runs the same number of batches
+        self.num_samples = (len(data_source) + num_replicas - 1) // num_replicas
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        n = len(self.data_source)
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(n, generator=g).tolist()
+        else:
+            order = list(range(n))
+        order += order[:self.num_samples * self.num_replicas - n]
+        order = order[self.rank::self.num_replicas]
+        return iter(order[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class CheckpointManager(object):
+    """ writes the full training state (model, optimizer, scheduler, rng, counters) to
+        directory every every_steps steps and / or every every_minutes minutes, keeping the
+        last keep checkpoints. files are written to a temporary name and renamed, so a job
+        killed in the middle of a save never leaves a truncated checkpoint behind.
+        with an AsyncWriter, save only snapshots the state to cpu and the write happens in the
+        background """
+    def __init__(self, directory, prefix='ckpt', keep=3, every_steps=0, every_minutes=0., writer=None):
+        if keep < 1:
+            raise Exception('keep must be at least 1, got {}'.format(keep))
+        self.directory = directory
+        self.writer = writer
+        self.prefix = prefix
+        self.keep = keep
+        self.every_steps = every_steps
+        self.every_minutes = every_minutes
+        self.last_time = time.time()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, step):
+        return os.path.join(self.directory, '{}_{:09d}.pth'.format(self.prefix, step))
+
+    def checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.directory, '{}_*.pth'.format(self.prefix))))
+
+    def latest(self):
+        paths = self.checkpoints()
+        return paths[-1] if len(paths) > 0 else None
+
+    def due(self, step):
+        if self.every_steps > 0 and step % self.every_steps == 0:
+            return True
+        return self.every_minutes > 0 and time.time() - self.last_time >= 60. * self.every_minutes
+
+    def state(self, step, model, optimizer, scheduler=None, **counters):
+        state = {'step': step, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                 'rng': get_rng_state(), 'counters': counters}
+        if scheduler is not None:
+            state['scheduler'] = scheduler.state_dict()
+        return state
+
+    def write(self, state, path):
+        tmp = path + '.tmp'
+        torch.save(state, tmp)
+        os.replace(tmp, path)
+        for old in self.checkpoints()[:-self.keep]:
+            os.remove(old)
+        return path
+
+    def save(self, step, model, optimizer, scheduler=None, **counters):
+        """ counters : anything else needed to resume, e.g. epoch, batches done in the epoch """
+        self.last_time = time.time()
+        state = self.state(step, model, optimizer, scheduler, **counters)
+        if self.writer is None:
+            return self.write(state, self.path(step))
+        self.writer.submit(self.write, to_cpu(state), self.path(step))
+        return self.path(step)
+
+    def load(self, path, model, optimizer=None, scheduler=None, map_location='cpu'):
+        """ restores everything save wrote, returns (step, counters) """
+        state = torch.load(path, map_location=map_location)
+        model.load_state_dict(state['model'])
+        if optimizer is not None:
+            optimizer.load_state_dict(state['optimizer'])
+        if scheduler is not None and 'scheduler' in state:
+            scheduler.load_state_dict(state['scheduler'])
+        set_rng_state(state['rng'])
+        return state['step'], state['counters']
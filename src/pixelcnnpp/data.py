@@ -0,0 +1,106 @@
+import os
+import queue
+import threading
+import torch
+from torch.utils.data import Dataset, DataLoader, BatchSampler, SequentialSampler
+from torchvision import datasets
+
+
+def load_uint8(dataset, root, train=True, download=True):
+    """ decodes cifar / mnist once into uint8 images [N, C, H, W] and int64 labels, both in shared
+        memory so that loader workers read them without a copy, with fork or spawn """
+    if 'mnist' in dataset:
+        ds = datasets.MNIST(root, train=train, download=download)
+        images = torch.as_tensor(ds.data).unsqueeze(1)
+    elif 'cifar' in dataset:
+        ds = datasets.CIFAR10(root, train=train, download=download)
+        images = torch.from_numpy(ds.data).permute(0, 3, 1, 2)
+    else:
+        raise Exception('{} dataset not in [mnist, cifar]'.format(dataset))
+    labels = torch.as_tensor(ds.targets, dtype=torch.int64)
+    return images.contiguous().share_memory_(), labels.share_memory_()
+
+
+def rescale(x):
+    """ uint8 [0, 255] -> [-1, 1] for a whole batch, the same arithmetic as ToTensor followed by
+        the former per-image (x - .5) * 2. lambda """
+    return x.float().div_(255.).sub_(.5).mul_(2.)
+
+
+def default_workers(world_size=1):
+    """ the cores of this process minus the one running the training loop, scales with the
+        machine. --workers overrides it """
+    return max(0, (os.cpu_count() or 1) // world_size - 1)
+
+
+class UInt8Images(Dataset):
+    """ indexed with the list of indices of a whole batch, returns uint8 images and labels """
+    def __init__(self, images, labels):
+        self.images = images
+        self.labels = labels
+
+    def __len__(self):
+        return self.images.size(0)
+
+    def __getitem__(self, index):
+        index = torch.as_tensor(index)
+        return self.images[index], self.labels[index]
+
+
+def make_loader(images, labels, batch_size, sampler=None, drop_last=False, num_workers=None,
+                pin_memory=False, generator=None):
+    """ batches of uint8 images, sequential unless a sampler is given """
+    if sampler is None:
+        sampler = SequentialSampler(images)
+    num_workers = default_workers() if num_workers is None else num_workers
+    return DataLoader(UInt8Images(images, labels), batch_size=None,
+                      sampler=BatchSampler(sampler, batch_size, drop_last),
+                      num_workers=num_workers, pin_memory=pin_memory,
+                      persistent_workers=num_workers > 0, generator=generator)
+
+
+class Prefetcher(object):
+    """ iterates loader on a background thread, keeping depth batches ahead of the training loop,
+        each already moved to device and rescaled to [-1, 1] there. has the length of loader and
+        is iterated once per epoch like it """
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for images, labels in self.loader:
+                    if stop.is_set():
+                        return
+                    batches.put((rescale(images.to(self.device, non_blocking=True)), labels))
+            except Exception as e:
+                batches.put(e)
+                return
+            batches.put(None)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # the consumer stopped early (break, exception) : unblock and retire the producer
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=.1)
+                except queue.Empty:
+                    pass
@@ -0,0 +1,39 @@
+import torch
+
+
+def compile_model(model, **kwargs):
+    """ torch.compile the model, the eager module keeps working and shares its parameters """
+    if not hasattr(torch, 'compile'):
+        raise Exception('torch.compile needs pytorch >= 2.0, found {}'.format(torch.__version__))
+    return torch.compile(model, **kwargs)
+
+
+def export_torchscript(model, example, path=None):
+    """ trace an inference version of the model (eval mode, weight norm folded) to TorchScript,
+        the control flow only depends on shapes so tracing captures it exactly """
+    model.eval()
+    with torch.no_grad():
+        # fills the padding cache so the traced graph does not capture its creation
+        model(example, sample=True)
+        model.fold_weight_norm()
+        try:
+            traced = torch.jit.trace(model, (example,), check_trace=False)
+        finally:
+            model.unfold_weight_norm()
+    if path is not None:
+        traced.save(path)
+    return traced
+
+
+def export_program(model, example):
+    """ torch.export an inference version of the model (eval mode, weight norm folded) """
+    if not hasattr(torch, 'export'):
+        raise Exception('torch.export needs pytorch >= 2.1, found {}'.format(torch.__version__))
+    model.eval()
+    with torch.no_grad():
+        model(example, sample=True)
+    model.fold_weight_norm()
+    try:
+        return torch.export.export(model, (example,))
+    finally:
+        model.unfold_weight_norm()
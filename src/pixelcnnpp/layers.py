@@ -5,25 +5,51 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.nn.utils import weight_norm as wn
+from torch.nn.utils.weight_norm import WeightNorm
 import numpy as np
 
+
+def fold_weight_norm(module):
+    """ bake g * v / ||v|| of every weight-normed submodule into a plain weight so that forward
+        no longer recomputes it. the hooks are returned to unfold_weight_norm, g and v are left
+        untouched so training resumes exactly where it was """
+    folded = []
+    for m in module.modules():
+        for key, hook in list(m._forward_pre_hooks.items()):
+            if isinstance(hook, WeightNorm):
+                del m._forward_pre_hooks[key]
+                with torch.no_grad():
+                    setattr(m, hook.name, hook.compute_weight(m))
+                folded.append((m, key, hook))
+    return folded
+
+
+def unfold_weight_norm(folded):
+    """ reinstall the hooks removed by fold_weight_norm """
+    for m, key, hook in folded:
+        m._forward_pre_hooks[key] = hook
+        setattr(m, hook.name, hook.compute_weight(m))
+
 class nin(nn.Module):
     def __init__(self, dim_in, dim_out):
         super(nin, self).__init__()
-        self.lin_a = wn(nn.Linear(dim_in, dim_out))
+        # a weight-normed 1x1 convolution : no permute / contiguous copies around a linear layer
+        self.lin_a = wn(nn.Conv2d(dim_in, dim_out, 1))
         self.dim_out = dim_out
+        self._register_load_state_dict_pre_hook(self.load_linear_weights)
+
+    @staticmethod
+    def load_linear_weights(state_dict, prefix, *args):
+        """ checkpoints written when lin_a was an nn.Linear hold [out, in] / [out, 1] weights """
+        for name in ['weight_g', 'weight_v']:
+            key = prefix + 'lin_a.' + name
+            if key in state_dict and state_dict[key].dim() == 2:
+                state_dict[key] = state_dict[key][:, :, None, None]
 
     def forward(self, x):
-        og_x = x
         # assumes pytorch ordering
         """ a network in network layer (1x1 CONV) """
-        # TODO : try with original ordering
-        x = x.permute(0, 2, 3, 1)
-        shp = [int(y) for y in x.size()]
-        out = self.lin_a(x.contiguous().view(shp[0]*shp[1]*shp[2], shp[3]))
-        shp[-1] = self.dim_out
-        out = out.view(shp)
-        return out.permute(0, 3, 1, 2)
+        return self.lin_a(x)
 
 
 class down_shifted_conv2d(nn.Module):
@@ -45,29 +71,26 @@ class down_shifted_conv2d(nn.Module):
         elif norm == 'batch_norm':
             self.bn = nn.BatchNorm2d(num_filters_out)
 
-        if shift_output_down :
-            self.down_shift = lambda x : down_shift(x, pad=nn.ZeroPad2d((0, 0, 1, 0)))
-
-    def forward(self, x):
-        x = self.pad(x)
+    def forward(self, x, padded=False):
+        """ padded : x already carries self.pad, e.g. concat_elu(x, pad=self.pad.padding) """
+        x = x if padded else self.pad(x)
         x = self.conv(x)
         x = self.bn(x) if self.norm == 'batch_norm' else x
-        return self.down_shift(x) if self.shift_output_down else x
+        return down_shift(x) if self.shift_output_down else x
 
 
 class down_shifted_deconv2d(nn.Module):
     def __init__(self, num_filters_in, num_filters_out, filter_size=(2,3), stride=(1,1)):
         super(down_shifted_deconv2d, self).__init__()
+        # padding / output_padding crop the output to what the down shift keeps, without slicing
         self.deconv = wn(nn.ConvTranspose2d(num_filters_in, num_filters_out, filter_size, stride,
-                                            output_padding=1))
+                                            padding=(0, int((filter_size[1] - 1) / 2)),
+                                            output_padding=(2 - filter_size[0], 1)))
         self.filter_size = filter_size
         self.stride = stride
 
     def forward(self, x):
-        x = self.deconv(x)
-        xs = [int(y) for y in x.size()]
-        return x[:, :, :(xs[2] - self.filter_size[0] + 1),
-                 int((self.filter_size[1] - 1) / 2):(xs[3] - int((self.filter_size[1] - 1) / 2))]
+        return self.deconv(x)
 
 
 class down_right_shifted_conv2d(nn.Module):
@@ -86,30 +109,27 @@ class down_right_shifted_conv2d(nn.Module):
         elif norm == 'batch_norm':
             self.bn = nn.BatchNorm2d(num_filters_out)
 
-        if shift_output_right :
-            self.right_shift = lambda x : right_shift(x, pad=nn.ZeroPad2d((1, 0, 0, 0)))
-
-    def forward(self, x):
-        x = self.pad(x)
+    def forward(self, x, padded=False):
+        """ padded : x already carries self.pad, e.g. concat_elu(x, pad=self.pad.padding) """
+        x = x if padded else self.pad(x)
         x = self.conv(x)
         x = self.bn(x) if self.norm == 'batch_norm' else x
-        return self.right_shift(x) if self.shift_output_right else x
+        return right_shift(x) if self.shift_output_right else x
 
 
 class down_right_shifted_deconv2d(nn.Module):
     def __init__(self, num_filters_in, num_filters_out, filter_size=(2,2), stride=(1,1),
                     shift_output_right=False):
         super(down_right_shifted_deconv2d, self).__init__()
+        # output_padding crops the output to what the down-right shift keeps, without slicing
         self.deconv = wn(nn.ConvTranspose2d(num_filters_in, num_filters_out, filter_size,
-                                                stride, output_padding=1))
+                                                stride, output_padding=(2 - filter_size[0],
+                                                                        2 - filter_size[1])))
         self.filter_size = filter_size
         self.stride = stride
 
     def forward(self, x):
-        x = self.deconv(x)
-        xs = [int(y) for y in x.size()]
-        x = x[:, :, :(xs[2] - self.filter_size[0] + 1):, :(xs[3] - self.filter_size[1] + 1)]
-        return x
+        return self.deconv(x)
 
 
 '''
@@ -131,13 +151,27 @@ class gated_resnet(nn.Module):
         self.conv_out = conv_op(2 * num_filters, 2 * num_filters)
 
 
-    def forward(self, og_x, a=None):
-        x = self.conv_input(self.nonlinearity(og_x))
-        if a is not None :
-            x += self.nin_skip(self.nonlinearity(a))
-        x = self.nonlinearity(x)
+    def padded_nonlinearity(self, x):
+        """ nonlinearity(x) written into a zero-padded buffer ready for conv_input and conv_out,
+            so that the shifted convolutions do not copy their input to pad it """
+        return self.nonlinearity(x, self.conv_input.pad.padding)
+
+    def unpad(self, x):
+        """ the unpadded view of a padded_nonlinearity output """
+        left, right, top, bottom = self.conv_input.pad.padding
+        return x[:, :, top:x.size(2) - bottom, left:x.size(3) - right]
+
+    def forward(self, og_x, a=None, og_x_nl=None, a_nl=None):
+        """ og_x_nl : padded_nonlinearity(og_x), a_nl : nonlinearity(a), when the caller already has them """
+        og_x_nl = self.padded_nonlinearity(og_x) if og_x_nl is None else og_x_nl
+        x = self.conv_input(og_x_nl, padded=True)
+        if a is not None or a_nl is not None :
+            a_nl = self.nonlinearity(a) if a_nl is None else a_nl
+            x += self.nin_skip(a_nl)
+        # dropout2d zeroes or scales whole channels : the padding stays zero
+        x = self.padded_nonlinearity(x)
         x = self.dropout(x)
-        x = self.conv_out(x)
+        x = self.conv_out(x, padded=True)
         a, b = torch.chunk(x, 2, dim=1)
-        c3 = a * torch.sigmoid(b)
-        return og_x + c3
+        # og_x + a * sigmoid(b) without the intermediate product
+        return torch.addcmul(og_x, a, torch.sigmoid(b))
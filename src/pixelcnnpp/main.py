@@ -1,16 +1,21 @@
 import time
 import os
 import argparse
+import datetime
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.distributed as dist
 from torch.optim import lr_scheduler
-from torchvision import datasets, transforms, utils
+from torch.nn.parallel import DistributedDataParallel
+from torchvision import utils
 # from tensorboardX import SummaryWriter
 from torch.utils.tensorboard import SummaryWriter
 from utils import *
 from model import *
+from checkpoint import CheckpointManager, ResumableSampler, AsyncWriter, to_cpu
+from data import load_uint8, make_loader, default_workers, Prefetcher
 from PIL import Image
 
 parser = argparse.ArgumentParser()
@@ -27,6 +32,20 @@ parser.add_argument('-t', '--save_interval', type=int, default=10,
                     help='Every how many epochs to write checkpoint/samples?')
 parser.add_argument('-r', '--load_params', type=str, default=None,
                     help='Restore training from previous model checkpoint?')
+parser.add_argument('-R', '--resume', action='store_true',
+                    help='Resume from the latest full training checkpoint in save_dir, if there is one')
+parser.add_argument('-k', '--ckpt_every', type=int, default=0,
+                    help='Every how many steps to write a full training checkpoint? 0 = end of epoch only')
+parser.add_argument('-K', '--ckpt_minutes', type=float, default=0.,
+                    help='Every how many minutes to write a full training checkpoint? 0 = never')
+parser.add_argument('--ckpt_keep', type=int, default=3,
+                    help='Number of full training checkpoints to keep, at least 1')
+parser.add_argument('-v', '--eval_every', type=int, default=0,
+                    help='Every how many steps to evaluate on a fixed test subset? 0 = never')
+parser.add_argument('-V', '--eval_batches', type=int, default=10,
+                    help='Number of test batches in the fixed evaluation subset')
+parser.add_argument('-w', '--workers', type=int, default=-1,
+                    help='Loader workers per process, -1 scales them to the cores of the process')
 # model
 parser.add_argument('-q', '--nr_resnet', type=int, default=4,
                     help='Number of residual blocks per stage of the model')
@@ -34,131 +53,216 @@ parser.add_argument('-n', '--nr_filters', type=int, default=80,
                     help='Number of filters to use across the model. Higher = larger model.')
 parser.add_argument('-m', '--nr_logistic_mix', type=int, default=10,
                     help='Number of logistic components in the mixture. Higher = more flexible model')
+parser.add_argument('-P', '--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                    help='Precision policy: bf16 runs the convolutions in bfloat16, losses stay float32')
+parser.add_argument('-C', '--channels_last', action='store_true',
+                    help='Run the model in channels_last (NHWC) memory format')
+parser.add_argument('-g', '--grad_checkpoint', action='store_true',
+                    help='Recompute gated_resnet internals in backward, keeping only the skip tensors')
 parser.add_argument('-l', '--lr', type=float,
                     default=0.0002, help='Base learning rate')
 parser.add_argument('-e', '--lr_decay', type=float, default=0.999995,
                     help='Learning rate decay, applied every step of the optimization')
 parser.add_argument('-b', '--batch_size', type=int, default=64,
-                    help='Batch size during training per GPU')
+                    help='Batch size during training per process')
 parser.add_argument('-x', '--max_epochs', type=int,
                     default=100, help='How many epochs to run in total?')
 parser.add_argument('-s', '--seed', type=int, default=1,
                     help='Random seed to use')
+# distributed : torchrun --nnodes=H --nproc_per_node=N main.py ...
+parser.add_argument('-j', '--threads', type=int, default=0,
+                    help='Intra-op threads per process, 0 keeps the torch default')
+parser.add_argument('--backend', type=str, default='gloo',
+                    help='torch.distributed backend when launched with several processes')
+parser.add_argument('--dist_timeout', type=float, default=180.,
+                    help='Minutes a collective waits for the other processes, e.g. while rank 0 samples')
 args = parser.parse_args()
 
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+distributed = world_size > 1
+if distributed:
+    dist.init_process_group(backend=args.backend, timeout=datetime.timedelta(minutes=args.dist_timeout))
+rank = dist.get_rank() if distributed else 0
+# rank 0 writes tensorboard, checkpoints and samples
+is_main = rank == 0
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
 # reproducibility
 torch.manual_seed(args.seed)
 np.random.seed(args.seed)
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def all_reduce_sum(*values):
+    """ sums python numbers over all processes """
+    total = torch.tensor(values, dtype=torch.float64)
+    if distributed:
+        dist.all_reduce(total)
+    return total.tolist()
 
 model_name = 'pcnn_lr:{:.5f}_nr-resnet{}_nr-filters{}'.format(args.lr, args.nr_resnet, args.nr_filters)
 # assert not os.path.exists(os.path.join('runs', model_name)), '{} already exists!'.format(model_name)
-writer = SummaryWriter(log_dir=os.path.join('runs', model_name))
+writer = SummaryWriter(log_dir=os.path.join('runs', model_name)) if is_main else None
 
 sample_batch_size = 25
 obs = (1, 28, 28) if 'mnist' in args.dataset else (3, 32, 32)
 input_channels = obs[0]
-rescaling     = lambda x : (x - .5) * 2.
 rescaling_inv = lambda x : .5 * x  + .5
-kwargs = {'num_workers':1, 'pin_memory':True, 'drop_last':True}
-ds_transforms = transforms.Compose([transforms.ToTensor(), rescaling])
 
 if 'mnist' in args.dataset :
-    train_loader = torch.utils.data.DataLoader(datasets.MNIST(args.data_dir, download=True,
-                        train=True, transform=ds_transforms), batch_size=args.batch_size,
-                            shuffle=True, **kwargs)
-
-    test_loader  = torch.utils.data.DataLoader(datasets.MNIST(args.data_dir, train=False,
-                    transform=ds_transforms), batch_size=args.batch_size, shuffle=True, **kwargs)
-
     loss_op   = lambda real, fake : discretized_mix_logistic_loss_1d(real, fake)
     sample_op = lambda x : sample_from_discretized_mix_logistic_1d(x, args.nr_logistic_mix)
 
 elif 'cifar' in args.dataset :
-    train_loader = torch.utils.data.DataLoader(datasets.CIFAR10(args.data_dir, train=True,
-        download=True, transform=ds_transforms), batch_size=args.batch_size, shuffle=True, **kwargs)
-
-    test_loader  = torch.utils.data.DataLoader(datasets.CIFAR10(args.data_dir, train=False,
-                    transform=ds_transforms), batch_size=args.batch_size, shuffle=True, **kwargs)
-
-    loss_op   = lambda real, fake : discretized_mix_logistic_loss(real, fake)
+    loss_op   = lambda real, fake : discretized_mix_logistic_loss(real, fake).sum()
     sample_op = lambda x : sample_from_discretized_mix_logistic(x, args.nr_logistic_mix)
 else :
     raise Exception('{} dataset not in {mnist, cifar10}'.format(args.dataset))
 
-model = PixelCNN(nr_resnet=args.nr_resnet, nr_filters=args.nr_filters,
-            input_channels=input_channels, nr_logistic_mix=args.nr_logistic_mix)
-model = model.cuda()
+# uint8 images decoded once into shared memory, loaders gather whole batches and the
+# prefetchers move them to device and rescale them to [-1, 1] ahead of the training loop
+# rank 0 downloads and extracts, the other processes wait for it and only read data_dir
+if distributed and not is_main:
+    dist.barrier()
+train_images, train_labels = load_uint8(args.dataset, args.data_dir, train=True, download=is_main)
+test_images, test_labels   = load_uint8(args.dataset, args.data_dir, train=False, download=is_main)
+if distributed and is_main:
+    dist.barrier()
+
+# each process trains on its shard, test images are split without padding so bpd stays exact
+train_sampler = ResumableSampler(train_images, seed=args.seed, num_replicas=world_size, rank=rank)
+if distributed:
+    test_images, test_labels = test_images[rank::world_size], test_labels[rank::world_size]
+num_workers = default_workers(world_size) if args.workers < 0 else args.workers
+# loaders draw their worker seeds from their own generator, not the global one that a
+# checkpoint restores, so creating an iterator after resuming does not shift dropout masks
+train_loader = Prefetcher(make_loader(train_images, train_labels, args.batch_size, sampler=train_sampler,
+                    num_workers=num_workers, pin_memory=device.type == 'cuda',
+                    generator=torch.Generator().manual_seed(args.seed)), device)
+test_loader  = Prefetcher(make_loader(test_images, test_labels, args.batch_size,
+                    num_workers=num_workers, pin_memory=device.type == 'cuda',
+                    generator=torch.Generator().manual_seed(args.seed)), device)
+
+net = PixelCNN(nr_resnet=args.nr_resnet, nr_filters=args.nr_filters,
+            input_channels=input_channels, nr_logistic_mix=args.nr_logistic_mix,
+            precision=args.precision, channels_last=args.channels_last,
+            grad_checkpoint=args.grad_checkpoint)
+net = net.to(device)
 
 if args.load_params:
-    load_part_of_model(model, args.load_params)
+    load_part_of_model(net, args.load_params)
     # model.load_state_dict(torch.load(args.load_params))
     print('model parameters loaded')
 
+# gradients are all-reduced across processes, net stays the unwrapped module
+model = DistributedDataParallel(net) if distributed else net
+
 optimizer = optim.Adam(model.parameters(), lr=args.lr)
 scheduler = lr_scheduler.StepLR(optimizer, step_size=1, gamma=args.lr_decay)
 
+# checkpoints and sample images are written in the background by rank 0
+io_writer = AsyncWriter(max_pending=2) if is_main else None
+checkpoints = CheckpointManager(args.save_dir, prefix=model_name + '_ckpt', keep=args.ckpt_keep,
+                    every_steps=args.ckpt_every, every_minutes=args.ckpt_minutes, writer=io_writer)
+writes = 0
+global_step = 0
+start_epoch, start_batch = 0, 0
+if args.resume and checkpoints.latest() is not None:
+    # every process restores the same state, the sampler replays the rest of the interrupted epoch
+    global_step, counters = checkpoints.load(checkpoints.latest(), net, optimizer, scheduler)
+    start_epoch, start_batch, writes = counters['epoch'], counters['batches'], counters['writes']
+    print('resumed from step {}'.format(global_step))
+
 def sample(model):
     model.train(False)
-    data = torch.zeros(sample_batch_size, obs[0], obs[1], obs[2])
-    data = data.cuda()
-    for i in range(obs[1]):
-        for j in range(obs[2]):
-            data_v = Variable(data, volatile=True)
-            out   = model(data_v, sample=True)
-            out_sample = sample_op(out)
-            data[:, :, i, j] = out_sample.data[:, :, i, j]
+    # weight norm is constant while sampling : compute it once instead of once per pixel
+    model.fold_weight_norm()
+    data = torch.zeros(sample_batch_size, obs[0], obs[1], obs[2], device=device)
+    try:
+        for i in range(obs[1]):
+            for j in range(obs[2]):
+                with torch.no_grad():
+                    out   = model(data, sample=True)
+                    out_sample = sample_op(out)
+                data[:, :, i, j] = out_sample.data[:, :, i, j]
+    finally:
+        # never hand a folded model back to training
+        model.unfold_weight_norm()
     return data
 
 print('starting training')
-writes = 0
-for epoch in range(args.max_epochs):
+for epoch in range(start_epoch, args.max_epochs):
     model.train(True)
-    torch.cuda.synchronize()
-    train_loss = 0.
+    train_sampler.set_epoch(epoch, start_batch * args.batch_size)
+    if device.type == 'cuda': torch.cuda.synchronize()
+    # summed on device : no host sync per step, .item() only every print_every batches
+    train_loss, train_count = torch.zeros((), dtype=torch.float64, device=device), 0
     time_ = time.time()
     model.train()
-    for batch_idx, (input,_) in enumerate(train_loader):
-        input = input.cuda()
-        input = Variable(input)
+    for batch_idx, (input,_) in enumerate(train_loader, start_batch):
         output = model(input)
         loss = loss_op(input, output)
-        train_loss += loss.data
+        train_loss += loss.detach()
+        train_count += input.size(0)
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
+        global_step += 1
+        if args.eval_every > 0 and global_step % args.eval_every == 0 :
+            # the test loader is not shuffled : its first batches are the same subset every time
+            nll, count = all_reduce_sum(*evaluate_nll(net, test_loader, loss_op, device,
+                                                      max_batches=args.eval_batches))
+            if is_main:
+                writer.add_scalar('test/bpd_subset', bits_per_dim(nll, count, obs), global_step)
         if (batch_idx +1) % args.print_every == 0 :
-            deno = args.print_every * args.batch_size * np.prod(obs) * np.log(2.)
-            writer.add_scalar('train/bpd', (train_loss / deno), writes)
-            print('loss : {:.4f}, time : {:.4f}'.format(
-                (train_loss / deno),
-                (time.time() - time_)))
-            train_loss = 0.
+            total_loss, total_count = all_reduce_sum(train_loss.item(), train_count)
+            train_bpd = bits_per_dim(total_loss, total_count, obs)
+            if is_main:
+                writer.add_scalar('train/bpd', train_bpd, writes)
+                print('loss : {:.4f}, time : {:.4f}'.format(
+                    train_bpd,
+                    (time.time() - time_)))
+            train_loss.zero_()
+            train_count = 0
             writes += 1
             time_ = time.time()
-
+        if is_main and checkpoints.due(global_step):
+            checkpoints.save(global_step, net, optimizer, scheduler,
+                             epoch=epoch, batches=batch_idx + 1, writes=writes)
+    start_batch = 0
 
     # decrease learning rate
     scheduler.step()
 
-    torch.cuda.synchronize()
-    model.eval()
-    test_loss = 0.
-    for batch_idx, (input,_) in enumerate(test_loader):
-        input = input.cuda()
-        input_var = Variable(input)
-        output = model(input_var)
-        loss = loss_op(input_var, output)
-        test_loss += loss.data
-        del loss, output
-
-    deno = batch_idx * args.batch_size * np.prod(obs) * np.log(2.)
-    writer.add_scalar('test/bpd', (test_loss / deno), writes)
-    print('test loss : %s' % (test_loss / deno))
-
-    if (epoch + 1) % args.save_interval == 0:
-        torch.save(model.state_dict(), 'models/{}_{}.pth'.format(model_name, epoch))
+    if device.type == 'cuda': torch.cuda.synchronize()
+    test_loss, test_count = all_reduce_sum(*evaluate_nll(net, test_loader, loss_op, device))
+    test_bpd = bits_per_dim(test_loss, test_count, obs)
+    if is_main:
+        writer.add_scalar('test/bpd', test_bpd, writes)
+        print('test loss : %s' % test_bpd)
+
+    if is_main and (epoch + 1) % args.save_interval == 0:
+        io_writer.submit(torch.save, to_cpu(net.state_dict()), 'models/{}_{}.pth'.format(model_name, epoch))
         print('sampling...')
-        sample_t = sample(model)
+        sample_t = sample(net)
         sample_t = rescaling_inv(sample_t)
-        utils.save_image(sample_t,'images/{}_{}.png'.format(model_name, epoch),
+        io_writer.submit(utils.save_image, to_cpu(sample_t), 'images/{}_{}.png'.format(model_name, epoch),
                 nrow=5, padding=0)
+
+    # after sampling, which draws from the rng, so that a resumed run continues the same stream
+    if is_main:
+        checkpoints.save(global_step, net, optimizer, scheduler,
+                         epoch=epoch + 1, batches=0, writes=writes)
+    # the other processes wait here for rank 0 to sample, not inside the next all-reduce
+    if distributed:
+        dist.barrier()
+
+if is_main:
+    io_writer.close()
+    io_stats = io_writer.stats()
+    print('background writes : {}, mean {:.3f}s, max {:.3f}s, training blocked {:.3f}s'.format(
+        io_stats['writes'], io_stats['write_mean'], io_stats['write_max'], io_stats['submit_wait_total']))
+
+if distributed:
+    dist.destroy_process_group()
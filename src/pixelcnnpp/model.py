@@ -5,12 +5,21 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from .layers import *
 from .utils import *
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 
+
+def skip_cat_block(block, ul, u, ul_skip):
+    """ ul step of the down pass, the concatenated skip is built inside so that a
+        checkpointed block does not keep it alive """
+    return block(ul, torch.cat((u, ul_skip), 1))
+
+
 class PixelCNNLayer_up(nn.Module):
-    def __init__(self, nr_resnet, nr_filters, resnet_nonlinearity):
+    def __init__(self, nr_resnet, nr_filters, resnet_nonlinearity, grad_checkpoint=False):
         super(PixelCNNLayer_up, self).__init__()
         self.nr_resnet = nr_resnet
+        self.grad_checkpoint = grad_checkpoint
         # stream from pixels above
         self.u_stream = nn.ModuleList([gated_resnet(nr_filters, down_shifted_conv2d,
                                         resnet_nonlinearity, skip_connection=0)
@@ -24,9 +33,17 @@ class PixelCNNLayer_up(nn.Module):
     def forward(self, u, ul):
         u_list, ul_list = [], []
 
-        for i in range(self.nr_resnet):
-            u  = self.u_stream[i](u)
-            ul = self.ul_stream[i](ul, a=u)
+        # nonlinearity(u) feeds both the next u block (padded) and the ul skip : evaluate it once
+        u_nl = None
+        for u_block, ul_block in zip(self.u_stream, self.ul_stream):
+            if self.grad_checkpoint and torch.is_grad_enabled():
+                # keep only the block outputs, block internals are recomputed in backward
+                u  = checkpoint(u_block, u, use_reentrant=False)
+                ul = checkpoint(ul_block, ul, u, use_reentrant=False)
+            else:
+                u  = u_block(u, og_x_nl=u_nl)
+                u_nl = u_block.padded_nonlinearity(u)
+                ul = ul_block(ul, a_nl=u_block.unpad(u_nl))
             u_list  += [u]
             ul_list += [ul]
 
@@ -34,9 +51,10 @@ class PixelCNNLayer_up(nn.Module):
 
 
 class PixelCNNLayer_down(nn.Module):
-    def __init__(self, nr_resnet, nr_filters, resnet_nonlinearity):
+    def __init__(self, nr_resnet, nr_filters, resnet_nonlinearity, grad_checkpoint=False):
         super(PixelCNNLayer_down, self).__init__()
         self.nr_resnet = nr_resnet
+        self.grad_checkpoint = grad_checkpoint
         # stream from pixels above
         self.u_stream  = nn.ModuleList([gated_resnet(nr_filters, down_shifted_conv2d,
                                         resnet_nonlinearity, skip_connection=1)
@@ -48,34 +66,46 @@ class PixelCNNLayer_down(nn.Module):
                                             for _ in range(nr_resnet)])
 
     def forward(self, u, ul, u_list, ul_list):
-        for i in range(self.nr_resnet):
-            u  = self.u_stream[i](u, a=u_list.pop())
-            ul = self.ul_stream[i](ul, a=torch.cat((u, ul_list.pop()), 1))
+        # u_list / ul_list : skip activations, in the order this layer consumes them
+        for u_block, ul_block, u_skip, ul_skip in zip(self.u_stream, self.ul_stream,
+                                                      u_list, ul_list):
+            if self.grad_checkpoint and torch.is_grad_enabled():
+                u  = checkpoint(u_block, u, u_skip, use_reentrant=False)
+                ul = checkpoint(skip_cat_block, ul_block, ul, u, ul_skip, use_reentrant=False)
+            else:
+                u  = u_block(u, a=u_skip)
+                ul = skip_cat_block(ul_block, ul, u, ul_skip)
 
         return u, ul
 
 
 class PixelCNN(nn.Module):
     def __init__(self, nr_resnet=5, nr_filters=80, nr_logistic_mix=10,
-                    resnet_nonlinearity='concat_elu', input_channels=3):
+                    resnet_nonlinearity='concat_elu', input_channels=3, precision='fp32',
+                    channels_last=False, grad_checkpoint=False):
         super(PixelCNN, self).__init__()
+        assert precision in PRECISIONS, '{} not in {}'.format(precision, PRECISIONS)
         if resnet_nonlinearity == 'concat_elu' :
-            self.resnet_nonlinearity = lambda x : concat_elu(x)
+            self.resnet_nonlinearity = concat_elu
         else :
             raise Exception('right now only concat elu is supported as resnet nonlinearity.')
 
         self.nr_filters = nr_filters
         self.input_channels = input_channels
         self.nr_logistic_mix = nr_logistic_mix
+        self.precision = precision
+        self.channels_last = channels_last
         self.right_shift_pad = nn.ZeroPad2d((1, 0, 0, 0))
         self.down_shift_pad  = nn.ZeroPad2d((0, 0, 1, 0))
 
         down_nr_resnet = [nr_resnet] + [nr_resnet + 1] * 2
         self.down_layers = nn.ModuleList([PixelCNNLayer_down(down_nr_resnet[i], nr_filters,
-                                                self.resnet_nonlinearity) for i in range(3)])
+                                                self.resnet_nonlinearity, grad_checkpoint)
+                                                    for i in range(3)])
 
         self.up_layers   = nn.ModuleList([PixelCNNLayer_up(nr_resnet, nr_filters,
-                                                self.resnet_nonlinearity) for _ in range(3)])
+                                                self.resnet_nonlinearity, grad_checkpoint)
+                                                    for _ in range(3)])
 
         self.downsize_u_stream  = nn.ModuleList([down_shifted_conv2d(nr_filters, nr_filters,
                                                     stride=(2,2)) for _ in range(2)])
@@ -99,77 +129,147 @@ class PixelCNN(nn.Module):
 
         num_mix = 3 if self.input_channels == 1 else 10
         self.nin_out = nin(nr_filters, num_mix * nr_logistic_mix)
-        self.init_padding = None
-
+        # follows the model across .to(device), never stored in checkpoints
+        self.register_buffer('init_padding', None, persistent=False)
+        self.folded_weight_norm = None
+        if channels_last:
+            # NHWC activations and weights : the layout oneDNN convolutions prefer on CPU
+            self.to(memory_format=torch.channels_last)
+
+
+    def fold_weight_norm(self):
+        """ bake the weight-normed weights into plain convolutions for evaluation and sampling,
+            call after moving the model to its device and unfold before training again """
+        if self.folded_weight_norm is None:
+            self.folded_weight_norm = fold_weight_norm(self)
+        return self
+
+
+    def unfold_weight_norm(self):
+        if self.folded_weight_norm is not None:
+            unfold_weight_norm(self.folded_weight_norm)
+            self.folded_weight_norm = None
+        return self
+
+
+    def padding(self, x):
+        """ ones channel marking the image support, cached per spatial shape, device and dtype
+            and broadcast over the batch so that any batch size reuses the same storage """
+        xs = [int(y) for y in x.size()]
+        pad = self.init_padding
+        if (pad is None or list(pad.size()[2:]) != xs[2:] or pad.device != x.device
+                or pad.dtype != x.dtype):
+            # a regular tensor even when first built under inference mode, training reuses it
+            with torch.inference_mode(False):
+                pad = self.init_padding = x.new_ones(1, 1, xs[2], xs[3])
+        return pad.expand(xs[0], 1, xs[2], xs[3])
 
     def forward(self, x, sample=False):
         # similar as done in the tf repo :
-        if self.init_padding is None and not sample:
-            xs = [int(y) for y in x.size()]
-            padding = Variable(torch.ones(xs[0], 1, xs[2], xs[3]), requires_grad=False)
-            self.init_padding = padding.cuda() if x.is_cuda else padding
-
-        if sample :
-            xs = [int(y) for y in x.size()]
-            padding = Variable(torch.ones(xs[0], 1, xs[2], xs[3]), requires_grad=False)
-            padding = padding.cuda() if x.is_cuda else padding
-            x = torch.cat((x, padding), 1)
-
-        ###      UP PASS    ###
-        x = x if sample else torch.cat((x, self.init_padding), 1)
-        # apply conv then remove the last row
-        u_list  = [self.u_init(x)]
-        # remove last row  + remove last column
-        ul_list = [self.ul_init[0](x) + self.ul_init[1](x)]
-        for i in range(3):
-            # resnet block
-            u_out, ul_out = self.up_layers[i](u_list[-1], ul_list[-1])
-            u_list  += u_out
-            ul_list += ul_out
-
-            if i != 2:
-                # downscale (only twice)
-                u_list  += [self.downsize_u_stream[i](u_list[-1])]
-                ul_list += [self.downsize_ul_stream[i](ul_list[-1])]
-
-        ###    DOWN PASS    ###
-        u  = u_list.pop()
-        ul = ul_list.pop()
-
-        for i in range(3):
-            # resnet block
-            u, ul = self.down_layers[i](u, ul, u_list, ul_list)
-
-            # upscale (only twice)
-            if i != 2 :
-                u  = self.upsize_u_stream[i](u)
-                ul = self.upsize_ul_stream[i](ul)
-
-        x_out = self.nin_out(F.elu(ul))
-
-        assert len(u_list) == len(ul_list) == 0, pdb.set_trace()
-
-        return x_out
+        # convolutions follow the precision policy, the output is handed back in float32
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with precision_scope(x, self.precision):
+            ###      UP PASS    ###
+            x = torch.cat((x, self.padding(x)), 1)
+            # apply conv then remove the last row
+            u_list  = [self.u_init(x)]
+            # remove last row  + remove last column
+            ul_list = [self.ul_init[0](x) + self.ul_init[1](x)]
+            for i in range(3):
+                # resnet block
+                u_out, ul_out = self.up_layers[i](u_list[-1], ul_list[-1])
+                u_list  += u_out
+                ul_list += ul_out
+
+                if i != 2:
+                    # downscale (only twice)
+                    u_list  += [self.downsize_u_stream[i](u_list[-1])]
+                    ul_list += [self.downsize_ul_stream[i](ul_list[-1])]
+
+            ###    DOWN PASS    ###
+            # consumes the up pass activations from last to first
+            u_list, ul_list = u_list[::-1], ul_list[::-1]
+            u  = u_list[0]
+            ul = ul_list[0]
+
+            start = 1
+            for i in range(3):
+                # resnet block
+                end = start + self.down_layers[i].nr_resnet
+                u, ul = self.down_layers[i](u, ul, u_list[start:end], ul_list[start:end])
+                start = end
+
+                # upscale (only twice)
+                if i != 2 :
+                    u  = self.upsize_u_stream[i](u)
+                    ul = self.upsize_ul_stream[i](ul)
+
+            x_out = self.nin_out(F.elu(ul))
+
+        assert start == len(u_list) == len(ul_list)
+
+        return x_out.float()
 
 
 if __name__ == '__main__':
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
     ''' testing loss with tf version '''
     np.random.seed(1)
     xx_t = (np.random.rand(15, 32, 32, 100) * 3).astype('float32')
     yy_t  = np.random.uniform(-1, 1, size=(15, 32, 32, 3)).astype('float32')
-    x_t = Variable(torch.from_numpy(xx_t)).cuda()
-    y_t = Variable(torch.from_numpy(yy_t)).cuda()
+    x_t = torch.from_numpy(xx_t).permute(0, 3, 1, 2).to(device)
+    y_t = torch.from_numpy(yy_t).permute(0, 3, 1, 2).to(device)
     loss = discretized_mix_logistic_loss(y_t, x_t)
 
     ''' testing model and deconv dimensions '''
-    x = torch.cuda.FloatTensor(32, 3, 32, 32).uniform_(-1., 1.)
-    xv = Variable(x).cpu()
-    ds = down_shifted_deconv2d(3, 40, stride=(2,2))
-    x_v = Variable(x)
+    x = torch.empty(32, 3, 32, 32, device=device).uniform_(-1., 1.)
+    ds = down_shifted_deconv2d(3, 40, stride=(2,2)).to(device)
+    ds(x)
 
     ''' testing loss compatibility '''
     model = PixelCNN(nr_resnet=3, nr_filters=100, input_channels=x.size(1))
-    model = model.cuda()
-    out = model(x_v)
-    loss = discretized_mix_logistic_loss(x_v, out)
-    print('loss : %s' % loss.data[0])
+    model = model.to(device)
+    out = model(x)
+    loss = discretized_mix_logistic_loss(x, out)
+    print('loss : %s' % loss.sum().item())
+
+    ''' testing the padded nonlinearity : same as padding concat_elu(x) '''
+    y = torch.randn(4, 8, 16, 16, device=device)
+    for pad in [(1, 1, 1, 0), (1, 0, 1, 0)]:
+        assert torch.allclose(concat_elu(y, pad), F.pad(concat_elu(y), pad))
+
+    ''' testing two training steps : the weight-normed parameters reach every forward '''
+    torch.manual_seed(1)
+    model = PixelCNN(nr_resnet=1, nr_filters=32, input_channels=x.size(1)).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    for _ in range(2):
+        loss = discretized_mix_logistic_loss(x, model(x)).sum()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    assert model.nin_out.lin_a.weight_g.grad.abs().sum().item() > 0
+    model.eval()
+    with torch.no_grad():
+        out = model(x)
+        # checkpoints of the nn.Linear nin still load
+        state = model.state_dict()
+        for key in list(state.keys()):
+            if '.lin_a.weight_' in key:
+                state[key] = state[key].flatten(1)
+        model.load_state_dict(state)
+        assert torch.equal(out, model(x))
+
+    ''' testing bf16 parity : bits/dim drift on a fixed batch, within 0.02 bits/dim '''
+    torch.manual_seed(1)
+    x = torch.empty(16, 3, 32, 32, device=device).uniform_(-1., 1.)
+    model = PixelCNN(nr_resnet=3, nr_filters=100, input_channels=x.size(1)).to(device).eval()
+    deno = x.numel() * np.log(2.)
+    with torch.no_grad():
+        bpd_fp32 = discretized_mix_logistic_loss(x, model(x)).sum().item() / deno
+        model.precision = 'bf16'
+        bpd_bf16 = discretized_mix_logistic_loss(x, model(x)).sum().item() / deno
+    print('bpd fp32 : %.4f, bpd bf16 : %.4f, drift : %.2e' % (bpd_fp32, bpd_bf16,
+            abs(bpd_bf16 - bpd_fp32)))
+    assert abs(bpd_bf16 - bpd_fp32) < 0.02, 'bf16 drifts by more than 0.02 bits/dim'
@@ -5,12 +5,29 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from .layers import *
 from .utils import *
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 
+
+def skip_cat_block(block, ul, u, ul_skip):
+    """ ul step of the down pass, the concatenated skip is built inside so that a
+        checkpointed block does not keep it alive """
+    return block(ul, torch.cat((u, ul_skip), 1))
+
+
+def add_condition(t, h):
+    """ t + h where h holds one conditioning map per group of consecutive images of t,
+        broadcast over the group instead of repeated in memory """
+    if h.size(0) == t.size(0):
+        return t + h
+    return (t.view(h.size(0), -1, *t.shape[1:]) + h.unsqueeze(1)).reshape(t.shape)
+
+
 class PixelCNNLayer_up(nn.Module):
-    def __init__(self, nr_resnet, nr_filters, resnet_nonlinearity):
+    def __init__(self, nr_resnet, nr_filters, resnet_nonlinearity, grad_checkpoint=False):
         super(PixelCNNLayer_up, self).__init__()
         self.nr_resnet = nr_resnet
+        self.grad_checkpoint = grad_checkpoint
         # stream from pixels above
         self.u_stream = nn.ModuleList([gated_resnet(nr_filters, down_shifted_conv2d,
                                         resnet_nonlinearity, skip_connection=0)
@@ -24,9 +41,17 @@ class PixelCNNLayer_up(nn.Module):
     def forward(self, u, ul):
         u_list, ul_list = [], []
 
-        for i in range(self.nr_resnet):
-            u  = self.u_stream[i](u)
-            ul = self.ul_stream[i](ul, a=u)
+        # nonlinearity(u) feeds both the next u block (padded) and the ul skip : evaluate it once
+        u_nl = None
+        for u_block, ul_block in zip(self.u_stream, self.ul_stream):
+            if self.grad_checkpoint and torch.is_grad_enabled():
+                # keep only the block outputs, block internals are recomputed in backward
+                u  = checkpoint(u_block, u, use_reentrant=False)
+                ul = checkpoint(ul_block, ul, u, use_reentrant=False)
+            else:
+                u  = u_block(u, og_x_nl=u_nl)
+                u_nl = u_block.padded_nonlinearity(u)
+                ul = ul_block(ul, a_nl=u_block.unpad(u_nl))
             u_list  += [u]
             ul_list += [ul]
 
@@ -34,9 +59,10 @@ class PixelCNNLayer_up(nn.Module):
 
 
 class PixelCNNLayer_down(nn.Module):
-    def __init__(self, nr_resnet, nr_filters, resnet_nonlinearity):
+    def __init__(self, nr_resnet, nr_filters, resnet_nonlinearity, grad_checkpoint=False):
         super(PixelCNNLayer_down, self).__init__()
         self.nr_resnet = nr_resnet
+        self.grad_checkpoint = grad_checkpoint
         # stream from pixels above
         self.u_stream  = nn.ModuleList([gated_resnet(nr_filters, down_shifted_conv2d,
                                         resnet_nonlinearity, skip_connection=1)
@@ -48,34 +74,46 @@ class PixelCNNLayer_down(nn.Module):
                                             for _ in range(nr_resnet)])
 
     def forward(self, u, ul, u_list, ul_list):
-        for i in range(self.nr_resnet):
-            u  = self.u_stream[i](u, a=u_list.pop())
-            ul = self.ul_stream[i](ul, a=torch.cat((u, ul_list.pop()), 1))
+        # u_list / ul_list : skip activations, in the order this layer consumes them
+        for u_block, ul_block, u_skip, ul_skip in zip(self.u_stream, self.ul_stream,
+                                                      u_list, ul_list):
+            if self.grad_checkpoint and torch.is_grad_enabled():
+                u  = checkpoint(u_block, u, u_skip, use_reentrant=False)
+                ul = checkpoint(skip_cat_block, ul_block, ul, u, ul_skip, use_reentrant=False)
+            else:
+                u  = u_block(u, a=u_skip)
+                ul = skip_cat_block(ul_block, ul, u, ul_skip)
 
         return u, ul
 
 
 class PixelCNN(nn.Module):
     def __init__(self, nr_resnet=5, nr_filters=80, nr_logistic_mix=10,
-                    resnet_nonlinearity='concat_elu', input_channels=3):
+                    resnet_nonlinearity='concat_elu', input_channels=3, precision='fp32',
+                    channels_last=False, grad_checkpoint=False):
         super(PixelCNN, self).__init__()
+        assert precision in PRECISIONS, '{} not in {}'.format(precision, PRECISIONS)
         if resnet_nonlinearity == 'concat_elu' :
-            self.resnet_nonlinearity = lambda x : concat_elu(x)
+            self.resnet_nonlinearity = concat_elu
         else :
             raise Exception('right now only concat elu is supported as resnet nonlinearity.')
 
         self.nr_filters = nr_filters
         self.input_channels = input_channels
         self.nr_logistic_mix = nr_logistic_mix
+        self.precision = precision
+        self.channels_last = channels_last
         self.right_shift_pad = nn.ZeroPad2d((1, 0, 0, 0))
         self.down_shift_pad  = nn.ZeroPad2d((0, 0, 1, 0))
 
         down_nr_resnet = [nr_resnet] + [nr_resnet + 1] * 2
         self.down_layers = nn.ModuleList([PixelCNNLayer_down(down_nr_resnet[i], nr_filters,
-                                                self.resnet_nonlinearity) for i in range(3)])
+                                                self.resnet_nonlinearity, grad_checkpoint)
+                                                    for i in range(3)])
 
         self.up_layers   = nn.ModuleList([PixelCNNLayer_up(nr_resnet, nr_filters,
-                                                self.resnet_nonlinearity) for _ in range(3)])
+                                                self.resnet_nonlinearity, grad_checkpoint)
+                                                    for _ in range(3)])
 
         self.downsize_u_stream  = nn.ModuleList([down_shifted_conv2d(nr_filters, nr_filters,
                                                     stride=(2,2)) for _ in range(2)])
@@ -104,92 +142,173 @@ class PixelCNN(nn.Module):
 
         num_mix = 3 if self.input_channels == 1 else 10
         self.nin_out = nin(nr_filters, num_mix * nr_logistic_mix)
-        self.init_padding = None
+        # follows the model across .to(device), never stored in checkpoints
+        self.register_buffer('init_padding', None, persistent=False)
+        self.folded_weight_norm = None
+        if channels_last:
+            # NHWC activations and weights : the layout oneDNN convolutions prefer on CPU
+            self.to(memory_format=torch.channels_last)
+
 
+    def fold_weight_norm(self):
+        """ bake the weight-normed weights into plain convolutions for evaluation and sampling,
+            call after moving the model to its device and unfold before training again """
+        if self.folded_weight_norm is None:
+            self.folded_weight_norm = fold_weight_norm(self)
+        return self
 
-    def forward(self, x, latent, sample=False):
+
+    def unfold_weight_norm(self):
+        if self.folded_weight_norm is not None:
+            unfold_weight_norm(self.folded_weight_norm)
+            self.folded_weight_norm = None
+        return self
+
+
+    def padding(self, x):
+        """ ones channel marking the image support, cached per spatial shape, device and dtype
+            and broadcast over the batch so that any batch size reuses the same storage """
+        xs = [int(y) for y in x.size()]
+        pad = self.init_padding
+        if (pad is None or list(pad.size()[2:]) != xs[2:] or pad.device != x.device
+                or pad.dtype != x.dtype):
+            # a regular tensor even when first built under inference mode, training reuses it
+            with torch.inference_mode(False):
+                pad = self.init_padding = x.new_ones(1, 1, xs[2], xs[3])
+        return pad.expand(xs[0], 1, xs[2], xs[3])
+
+    def condition(self, latent):
+        """ conditioning projection of a batch of latents, computed once it can be passed to
+            forward as h for any number of images per latent """
+        with precision_scope(latent, self.precision):
+            return self.deconv_h(latent)
+
+    def forward(self, x, latent=None, sample=False, h=None):
         # similar as done in the tf repo :
         xs = [int(y) for y in x.size()]
-        if self.init_padding is None and not sample:
-            padding = Variable(torch.ones(xs[0], 1, xs[2], xs[3]), requires_grad=False)
-            self.init_padding = padding.cuda() if x.is_cuda else padding
-
-        if sample :
-            padding = Variable(torch.ones(xs[0], 1, xs[2], xs[3]), requires_grad=False)
-            padding = padding.cuda() if x.is_cuda else padding
-            x = torch.cat((x, padding), 1)
-
-        ###      UP PASS    ###
-        x = x if sample else torch.cat((x, self.init_padding), 1)
-        # [N, 3, 1024]
-        h = self.deconv_h(latent).view(xs[0], self.nr_filters, xs[2], xs[3])
-
-        #### >>> Just masking?
-        u_list  = [self.u_init(x) + h]
-        ul_list = [self.ul_init[0](x) + self.ul_init[1](x) + h]
-        for i in range(3):
-            # add latent to here before
-            # resnet block
-            u_out, ul_out = self.up_layers[i](u_list[-1], ul_list[-1])
-            u_list  += u_out
-            ul_list += ul_out
-
-            if i != 2:
-                # downscale (only twice)
-                u_list  += [self.downsize_u_stream[i](u_list[-1])]
-                ul_list += [self.downsize_ul_stream[i](ul_list[-1])]
-
-        ###    DOWN PASS    ###
-        u  = u_list.pop()
-        ul = ul_list.pop()
-
-        for i in range(3):
-            # resnet block
-            u, ul = self.down_layers[i](u, ul, u_list, ul_list)
-
-            # upscale (only twice)
-            if i != 2 :
-                u  = self.upsize_u_stream[i](u)
-                ul = self.upsize_ul_stream[i](ul)
-
-        x_out = self.nin_out(F.elu(ul))
-
-        # change to force them into the range
-        # out = x_out.permute(0, 2, 3, 1)
-        # # probs
-        # probs = out[:, :, :, :10]
-        # # means
-        # means = torch.clamp(out[:, :, :, 10:40], min=-1, max=1)
-        # # logscales
-        # log_scales = torch.clamp(out[:, :, :, 40:70], min=-7, max=-4)
-        # coeffs = torch.clamp(out[:, :, :, 70:], min=-1, max=1)
-        #
-        # out = torch.cat([probs, means, log_scales, coeffs], dim=-1)
-        # x_out = out.permute(0, 3, 1, 2)
-
-        assert len(u_list) == len(ul_list) == 0, pdb.set_trace()
-
-        return x_out
+
+        # convolutions follow the precision policy, the output is handed back in float32
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with precision_scope(x, self.precision):
+            ###      UP PASS    ###
+            x = torch.cat((x, self.padding(x)), 1)
+            # [N, 3, 1024]
+            if h is None:
+                h = self.deconv_h(latent).view(xs[0], self.nr_filters, xs[2], xs[3])
+
+            #### >>> Just masking?
+            u_list  = [add_condition(self.u_init(x), h)]
+            ul_list = [add_condition(self.ul_init[0](x) + self.ul_init[1](x), h)]
+            for i in range(3):
+                # add latent to here before
+                # resnet block
+                u_out, ul_out = self.up_layers[i](u_list[-1], ul_list[-1])
+                u_list  += u_out
+                ul_list += ul_out
+
+                if i != 2:
+                    # downscale (only twice)
+                    u_list  += [self.downsize_u_stream[i](u_list[-1])]
+                    ul_list += [self.downsize_ul_stream[i](ul_list[-1])]
+
+            ###    DOWN PASS    ###
+            # consumes the up pass activations from last to first
+            u_list, ul_list = u_list[::-1], ul_list[::-1]
+            u  = u_list[0]
+            ul = ul_list[0]
+
+            start = 1
+            for i in range(3):
+                # resnet block
+                end = start + self.down_layers[i].nr_resnet
+                u, ul = self.down_layers[i](u, ul, u_list[start:end], ul_list[start:end])
+                start = end
+
+                # upscale (only twice)
+                if i != 2 :
+                    u  = self.upsize_u_stream[i](u)
+                    ul = self.upsize_ul_stream[i](ul)
+
+            x_out = self.nin_out(F.elu(ul))
+
+            # change to force them into the range
+            # out = x_out.permute(0, 2, 3, 1)
+            # # probs
+            # probs = out[:, :, :, :10]
+            # # means
+            # means = torch.clamp(out[:, :, :, 10:40], min=-1, max=1)
+            # # logscales
+            # log_scales = torch.clamp(out[:, :, :, 40:70], min=-7, max=-4)
+            # coeffs = torch.clamp(out[:, :, :, 70:], min=-1, max=1)
+            #
+            # out = torch.cat([probs, means, log_scales, coeffs], dim=-1)
+            # x_out = out.permute(0, 3, 1, 2)
+
+        assert start == len(u_list) == len(ul_list)
+
+        return x_out.float()
+
+    def sample_conditional(self, latent, sample_op, n_per_latent=1):
+        """ n_per_latent images for every latent of the batch, [len(latent) * n_per_latent, C, H, W]
+            with the images of a latent consecutive. the conditioning projection is computed once
+            and broadcast over the images of its latent. the model is causal along rows, so the
+            pixels of row i come from a pass over the first rows only (rounded up to 4, the
+            downsampling factor) : about half the work of full passes """
+        was_training = self.training
+        folded_here = self.folded_weight_norm is None
+        self.eval()
+        self.fold_weight_norm()
+        try:
+            with torch.no_grad():
+                h = self.condition(latent)
+                H, W = h.size(2), h.size(3)
+                data = torch.zeros(latent.size(0) * n_per_latent, self.input_channels, H, W,
+                                   device=latent.device)
+                for i in range(H):
+                    rows = min(H, (i // 4 + 1) * 4)
+                    for j in range(W):
+                        out = self(data[:, :, :rows], h=h[:, :, :rows])
+                        data[:, :, i, j] = sample_op(out)[:, :, i, j]
+        finally:
+            # also when sampling raises : never leave a training model folded or in eval mode
+            if folded_here:
+                self.unfold_weight_norm()
+            self.train(was_training)
+        return data
 
 
 if __name__ == '__main__':
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
     ''' testing loss with tf version '''
     np.random.seed(1)
     xx_t = (np.random.rand(15, 32, 32, 100) * 3).astype('float32')
     yy_t  = np.random.uniform(-1, 1, size=(15, 32, 32, 3)).astype('float32')
-    x_t = Variable(torch.from_numpy(xx_t)).cuda()
-    y_t = Variable(torch.from_numpy(yy_t)).cuda()
+    x_t = torch.from_numpy(xx_t).permute(0, 3, 1, 2).to(device)
+    y_t = torch.from_numpy(yy_t).permute(0, 3, 1, 2).to(device)
     loss = discretized_mix_logistic_loss(y_t, x_t)
 
     ''' testing model and deconv dimensions '''
-    x = torch.cuda.FloatTensor(32, 3, 32, 32).uniform_(-1., 1.)
-    xv = Variable(x).cpu()
-    ds = down_shifted_deconv2d(3, 40, stride=(2,2))
-    x_v = Variable(x)
+    x = torch.empty(32, 3, 32, 32, device=device).uniform_(-1., 1.)
+    latent = torch.randn(32, 16, 32, 32, device=device)
+    ds = down_shifted_deconv2d(3, 40, stride=(2,2)).to(device)
+    ds(x)
 
     ''' testing loss compatibility '''
     model = PixelCNN(nr_resnet=3, nr_filters=100, input_channels=x.size(1))
-    model = model.cuda()
-    out = model(x_v)
-    loss = discretized_mix_logistic_loss(x_v, out)
-    print('loss : %s' % loss.data[0])
+    model = model.to(device)
+    out = model(x, latent)
+    loss = discretized_mix_logistic_loss(x, out)
+    print('loss : %s' % loss.sum().item())
+
+    ''' testing the cached conditioning and the row-cropped passes of the sampler '''
+    model.eval()
+    with torch.no_grad():
+        h = model.condition(latent[:8])
+        full = model(x[:32], latent[:8].repeat_interleave(4, dim=0))
+        assert torch.allclose(model(x[:32], h=h), full, atol=1e-4)
+        assert torch.allclose(model(x[:32, :, :8], h=h[:, :, :8]), full[:, :, :8], atol=1e-4)
+    sample_op = lambda x : sample_from_discretized_mix_logistic(x, 10)
+    samples = model.sample_conditional(latent[:2, :, :8, :8], sample_op, n_per_latent=3)
+    print('conditional samples : {}'.format(list(samples.size())))
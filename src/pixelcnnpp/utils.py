@@ -7,11 +7,41 @@ from torch.nn.utils import weight_norm as wn
 import numpy as np
 
 
-def concat_elu(x):
-    """ like concatenated ReLU (http://arxiv.org/abs/1603.05201), but then with ELU """
+# precision policies understood by PixelCNN: convolutions and linear layers run in
+# bfloat16 under 'bf16' while the mixture losses always reduce in float32
+PRECISIONS = ['fp32', 'bf16']
+
+
+def precision_scope(x, precision='fp32'):
+    """ autocast region for the given precision policy, following the device of x """
+    assert precision in PRECISIONS, '{} not in {}'.format(precision, PRECISIONS)
+    return torch.autocast(device_type=x.device.type, dtype=torch.bfloat16,
+                          enabled=(precision == 'bf16'))
+
+
+def concat_elu(x, pad=None):
+    """ like concatenated ReLU (http://arxiv.org/abs/1603.05201), but then with ELU
+        pad : (left, right, top, bottom) zero padding of the output, as F.pad, for the next conv
+        both paths allocate the output once per call and work in place on it. the output is not
+        taken from a reused buffer : the next convolution keeps it for its backward """
     # Pytorch ordering
     axis = len(x.size()) - 3
-    return F.elu(torch.cat([x, -x], dim=axis))
+    if pad is None:
+        # a single allocation : negate the second half and apply the elu in place
+        out = torch.cat([x, x], dim=axis)
+        out.narrow(axis, x.size(axis), x.size(axis)).neg_()
+        return F.elu(out, inplace=True)
+    xs = [int(y) for y in x.size()]
+    left, right, top, bottom = pad
+    memory_format = torch.channels_last if (x.is_contiguous(memory_format=torch.channels_last)
+                                            and not x.is_contiguous()) else torch.contiguous_format
+    out = torch.empty(xs[0], 2 * xs[1], xs[2] + top + bottom, xs[3] + left + right,
+                      dtype=x.dtype, device=x.device, memory_format=memory_format).zero_()
+    inner = out[:, :, top:top + xs[2], left:left + xs[3]]
+    inner[:, :xs[1]].copy_(x)
+    inner[:, xs[1]:].copy_(x).neg_()
+    # elu(0) = 0 : the padding stays zero
+    return F.elu(out, inplace=True)
 
 
 def log_sum_exp(x):
@@ -31,11 +61,13 @@ def log_prob_from_logits(x):
     return x - m - torch.log(torch.sum(torch.exp(x - m), dim=axis, keepdim=True))
 
 
+# the NHWC permute of a channels_last network output (PixelCNN(channels_last=True)) is already
+# contiguous : .contiguous() below copies only in the default NCHW layout, as it always did
 def discretized_mix_logistic_loss_pc(x, l):
     """ log-likelihood for mixture of discretized logistics, assumes the data has been rescaled to [-1,1] interval """
-    # Pytorch ordering
-    x = x.permute(0, 2, 3, 1)
-    l = l.permute(0, 2, 3, 1)
+    # Pytorch ordering, reductions in float32 whatever precision produced l
+    x = x.float().permute(0, 2, 3, 1)
+    l = l.float().permute(0, 2, 3, 1)
     xs = [int(y) for y in x.size()]
     ls = [int(y) for y in l.size()]
 
@@ -51,7 +83,7 @@ def discretized_mix_logistic_loss_pc(x, l):
     # here and below: getting the means and adjusting them based on preceding
     # sub-pixels
     x = x.contiguous()
-    x = x.unsqueeze(-1) + Variable(torch.zeros(xs + [nr_mix]).cuda(), requires_grad=False)
+    x = x.unsqueeze(-1).expand(xs + [nr_mix])
     m2 = (means[:, :, :, 1, :] + coeffs[:, :, :, 0, :]
                 * x[:, :, :, 0, :]).view(xs[0], xs[1], xs[2], 1, nr_mix)
 
@@ -105,9 +137,9 @@ def discretized_mix_logistic_loss_pc(x, l):
 
 def discretized_mix_logistic_loss(x, l):
     """ log-likelihood for mixture of discretized logistics, assumes the data has been rescaled to [-1,1] interval """
-    # Pytorch ordering
-    x = x.permute(0, 2, 3, 1)
-    l = l.permute(0, 2, 3, 1)
+    # Pytorch ordering, reductions in float32 whatever precision produced l
+    x = x.float().permute(0, 2, 3, 1)
+    l = l.float().permute(0, 2, 3, 1)
     xs = [int(y) for y in x.size()]
     ls = [int(y) for y in l.size()]
 
@@ -123,7 +155,7 @@ def discretized_mix_logistic_loss(x, l):
     # here and below: getting the means and adjusting them based on preceding
     # sub-pixels
     x = x.contiguous()
-    x = x.unsqueeze(-1) + Variable(torch.zeros(xs + [nr_mix]).cuda(), requires_grad=False)
+    x = x.unsqueeze(-1).expand(xs + [nr_mix])
     m2 = (means[:, :, :, 1, :] + coeffs[:, :, :, 0, :]
                 * x[:, :, :, 0, :]).view(xs[0], xs[1], xs[2], 1, nr_mix)
 
@@ -173,9 +205,9 @@ def discretized_mix_logistic_loss(x, l):
 
 def discretized_mix_logistic_loss_1d(x, l):
     """ log-likelihood for mixture of discretized logistics, assumes the data has been rescaled to [-1,1] interval """
-    # Pytorch ordering
-    x = x.permute(0, 2, 3, 1)
-    l = l.permute(0, 2, 3, 1)
+    # Pytorch ordering, reductions in float32 whatever precision produced l
+    x = x.float().permute(0, 2, 3, 1)
+    l = l.float().permute(0, 2, 3, 1)
     xs = [int(y) for y in x.size()]
     ls = [int(y) for y in l.size()]
 
@@ -188,7 +220,7 @@ def discretized_mix_logistic_loss_1d(x, l):
     # here and below: getting the means and adjusting them based on preceding
     # sub-pixels
     x = x.contiguous()
-    x = x.unsqueeze(-1) + Variable(torch.zeros(xs + [nr_mix]).cuda(), requires_grad=False)
+    x = x.unsqueeze(-1).expand(xs + [nr_mix])
 
     # means = torch.cat((means[:, :, :, 0, :].unsqueeze(3), m2, m3), dim=3)
     centered_x = x - means
@@ -220,9 +252,9 @@ def discretized_mix_logistic_loss_1d(x, l):
 
 def discretized_mix_logistic_density_1d(x, l):
     """ log-likelihood for mixture of discretized logistics, assumes the data has been rescaled to [-1,1] interval """
-    # Pytorch ordering
-    x = x.permute(0, 2, 3, 1)
-    l = l.permute(0, 2, 3, 1)
+    # Pytorch ordering, reductions in float32 whatever precision produced l
+    x = x.float().permute(0, 2, 3, 1)
+    l = l.float().permute(0, 2, 3, 1)
     xs = [int(y) for y in x.size()]
     ls = [int(y) for y in l.size()]
 
@@ -235,7 +267,7 @@ def discretized_mix_logistic_density_1d(x, l):
     # here and below: getting the means and adjusting them based on preceding
     # sub-pixels
     x = x.contiguous()
-    x = x.unsqueeze(-1) + Variable(torch.zeros(xs + [nr_mix]).cuda(), requires_grad=False)
+    x = x.unsqueeze(-1).expand(xs + [nr_mix])
 
     # means = torch.cat((means[:, :, :, 0, :].unsqueeze(3), m2, m3), dim=3)
     centered_x = x - means
@@ -268,10 +300,9 @@ def discretized_mix_logistic_density_1d(x, l):
 
 def to_one_hot(tensor, n, fill_with=1.):
     # we perform one hot encore with respect to the last axis
-    one_hot = torch.FloatTensor(tensor.size() + (n,)).zero_()
-    if tensor.is_cuda : one_hot = one_hot.cuda()
+    one_hot = torch.zeros(tensor.size() + (n,), device=tensor.device)
     one_hot.scatter_(len(tensor.size()), tensor.unsqueeze(-1), fill_with)
-    return Variable(one_hot)
+    return one_hot
 
 
 def sample_from_discretized_mix_logistic_1d(l, nr_mix):
@@ -285,8 +316,7 @@ def sample_from_discretized_mix_logistic_1d(l, nr_mix):
     l = l[:, :, :, nr_mix:].contiguous().view(xs + [nr_mix * 2]) # for mean, scale
 
     # sample mixture indicator from softmax
-    temp = torch.FloatTensor(logit_probs.size())
-    if l.is_cuda : temp = temp.cuda()
+    temp = torch.empty(logit_probs.size(), device=l.device)
     temp.uniform_(1e-5, 1. - 1e-5)
     temp = logit_probs.data - torch.log(- torch.log(temp))
     _, argmax = temp.max(dim=3)
@@ -297,10 +327,8 @@ def sample_from_discretized_mix_logistic_1d(l, nr_mix):
     means = torch.sum(l[:, :, :, :, :nr_mix] * sel, dim=4)
     log_scales = torch.clamp(torch.sum(
         l[:, :, :, :, nr_mix:2 * nr_mix] * sel, dim=4), min=-7.)
-    u = torch.FloatTensor(means.size())
-    if l.is_cuda : u = u.cuda()
+    u = torch.empty(means.size(), device=l.device)
     u.uniform_(1e-5, 1. - 1e-5)
-    u = Variable(u)
     x = means + torch.exp(log_scales) * (torch.log(u) - torch.log(1. - u))
     x0 = torch.clamp(torch.clamp(x[:, :, :, 0], min=-1.), max=1.)
     out = x0.unsqueeze(1)
@@ -317,8 +345,7 @@ def sample_from_discretized_mix_logistic(l, nr_mix):
     logit_probs = l[:, :, :, :nr_mix]
     l = l[:, :, :, nr_mix:].contiguous().view(xs + [nr_mix * 3])
     # sample mixture indicator from softmax
-    temp = torch.FloatTensor(logit_probs.size())
-    if l.is_cuda : temp = temp.cuda()
+    temp = torch.empty(logit_probs.size(), device=l.device)
     temp.uniform_(1e-5, 1. - 1e-5)
     temp = logit_probs.data - torch.log(- torch.log(temp))
     _, argmax = temp.max(dim=3)
@@ -333,10 +360,8 @@ def sample_from_discretized_mix_logistic(l, nr_mix):
         l[:, :, :, :, 2 * nr_mix:3 * nr_mix]) * sel, dim=4)
     # sample from logistic & clip to interval
     # we don't actually round to the nearest 8bit value when sampling
-    u = torch.FloatTensor(means.size())
-    if l.is_cuda : u = u.cuda()
+    u = torch.empty(means.size(), device=l.device)
     u.uniform_(1e-5, 1. - 1e-5)
-    u = Variable(u)
     x = means + torch.exp(log_scales) * (torch.log(u) - torch.log(1. - u))
     x0 = torch.clamp(torch.clamp(x[:, :, :, 0], min=-1.), max=1.)
     x1 = torch.clamp(torch.clamp(
@@ -358,8 +383,7 @@ def down_shift(x, pad=None):
     # when downshifting, the last row is removed
     x = x[:, :, :xs[2] - 1, :]
     # padding left, padding right, padding top, padding bottom
-    pad = nn.ZeroPad2d((0, 0, 1, 0)) if pad is None else pad
-    return pad(x)
+    return F.pad(x, (0, 0, 1, 0)) if pad is None else pad(x)
 
 
 def right_shift(x, pad=None):
@@ -368,8 +392,31 @@ def right_shift(x, pad=None):
     # when righshifting, the last column is removed
     x = x[:, :, :, :xs[3] - 1]
     # padding left, padding right, padding top, padding bottom
-    pad = nn.ZeroPad2d((1, 0, 0, 0)) if pad is None else pad
-    return pad(x)
+    return F.pad(x, (1, 0, 0, 0)) if pad is None else pad(x)
+
+
+def evaluate_nll(model, loader, loss_op, device, max_batches=None):
+    """ streams the negative log-likelihood (nats, summed by loss_op over each batch) and the
+        number of images of loader in inference mode, accumulating in float64. the first
+        max_batches batches only when given : a fixed subset for a non-shuffled loader """
+    was_training = model.training
+    model.eval()
+    nll = torch.zeros((), dtype=torch.float64, device=device)
+    count = 0
+    with torch.inference_mode():
+        for batch_idx, (input, _) in enumerate(loader):
+            if max_batches is not None and batch_idx >= max_batches:
+                break
+            input = input.to(device, non_blocking=True)
+            nll += loss_op(input, model(input)).double()
+            count += input.size(0)
+    model.train(was_training)
+    return nll.item(), count
+
+
+def bits_per_dim(nll, count, obs):
+    """ nll in nats summed over count images of shape obs """
+    return nll / (count * np.prod(obs) * np.log(2.))
 
 
 def load_part_of_model(model, path):
@@ -5,6 +5,8 @@ from pixelcnnpp.utils import *
 
 from vae.ops import *
 from vae.model_cifar import AE
+from vae.latent_cache import cache_latent_codes
+from utils.provider import PointCloudDataset
 import pdb
 
 import warnings
@@ -16,9 +18,11 @@ dim_embed = 128
 obs = (1, 8, 16)
 input_channels = obs[0]
 
-netV = AE(dim_embed).cuda()
+netV = AE(dim_embed).to(device)
 netA = PixelCNN(nr_resnet=args.nr_resnet, nr_filters=args.nr_filters,
-                input_channels=input_channels, nr_logistic_mix=args.nr_logistic_mix).to(device)
+                input_channels=input_channels, nr_logistic_mix=args.nr_logistic_mix,
+                precision=args.precision, channels_last=args.channels_last,
+                grad_checkpoint=args.grad_checkpoint).to(device)
 
 # netV.apply(Helper.weights_init)
 netA.apply(Helper.weights_init)
@@ -57,13 +61,17 @@ test_loader = DataLoader(testset, batch_size=args.batch_size, shuffle=False, num
 # ==================Training======================
 def sample(model, nsamples=2):
     model.train(False)
+    model.fold_weight_norm()
     data = torch.zeros(nsamples, obs[0], obs[1], obs[2]).to(device)
-    for i in range(obs[1]):
-        for j in range(obs[2]):
-            with torch.no_grad():
-                out = model(data, sample=True)
-                out_sample = sample_op(out)
-                data[:, :, i, j] = out_sample.data[:, :, i, j]
+    try:
+        for i in range(obs[1]):
+            for j in range(obs[2]):
+                with torch.no_grad():
+                    out = model(data, sample=True)
+                    out_sample = sample_op(out)
+                    data[:, :, i, j] = out_sample.data[:, :, i, j]
+    finally:
+        model.unfold_weight_norm()
     return data
 
 
@@ -75,6 +83,14 @@ def plot_pc(samples, epoch, name, nsamples=1, color=False):
 
 print('Load AE')
 netV.load_state_dict(torch.load(netV_path))
+# netV is frozen : its codes are computed once per AE checkpoint and streamed from disk.
+# eval mode, so batchnorm encodes (and decodes samples) with its running statistics and the
+# codes do not depend on the batch. before the cache, netV ran in train mode with batch statistics
+netV.eval()
+encode_loader = DataLoader(trainset, batch_size=args.batch_size, shuffle=False, num_workers=8)
+codes_path = cache_latent_codes(netV.encode, encode_loader, device, model_path, netV_path,
+                                renew=args.flag_renew_data)
+code_loader = PointCloudDataset(codes_path).loader(args.batch_size, shuffle=True, drop_last=True)
 
 start_time = time.time()
 if os.path.isfile(netA_path) and args.flag_retrain:
@@ -83,13 +99,11 @@ if os.path.isfile(netA_path) and args.flag_retrain:
 
 total_step = len(trainset) // args.batch_size
 for epoch in range(args.num_epochs):
-    for batch_idx, (batch_data, _) in enumerate(train_loader):
+    for batch_idx, z in enumerate(code_loader):
         #if batch_idx > 100: break
         optimizerA.zero_grad()
-        batch_data = batch_data.to(device)
-        z = netV.encode(batch_data).detach()
         #pdb.set_trace()
-        z = z.view(-1, 8, 16).unsqueeze(1)
+        z = z.to(device).view(-1, 8, 16).unsqueeze(1)
         try:
             out_params = netA(z)
         except:
@@ -8,7 +8,6 @@ import os
 import shutil
 import torch
 import numpy as np
-import pymorton as pm
 
 
 class Helper:
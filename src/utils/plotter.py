@@ -10,7 +10,6 @@ import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from mpl_toolkits.axes_grid1.inset_locator import zoomed_inset_axes, mark_inset
-from sklearn.manifold import TSNE
 from mpl_toolkits.mplot3d import Axes3D
 
 
@@ -140,6 +139,7 @@ class Plotter:
 
 	@staticmethod
 	def plot_tnse(fname):
+		from sklearn.manifold import TSNE
 		data = np.load(fname)
 		tsne = TSNE(n_components=2, verbose=1, perplexity=40, n_iter=300)
 		result = tsne.fit_transform(data)
@@ -6,10 +6,46 @@
 import os
 import torch
 import numpy as np
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 from utils.sfc import SFC
 # from sfc import SFC
 
 
+class PointCloudDataset(Dataset):
+	"""
+		point clouds [N, num_points, dim] (or any [N, ...] array, e.g. cached latent codes) of a .npy
+		file, memory-mapped: only the samples of a batch are read from disk, so memory stays flat
+		whatever the size of the file.
+		indexed with the indices of a whole batch (see loader), returns float32 [B, num_points, dim]
+		transform: applied to each batch tensor, e.g. a permutation to [B, dim, num_points]
+	"""
+	def __init__(self, path, normalized=False, transform=None):
+		self.points = np.load(path, mmap_mode='r')
+		self.normalized = normalized
+		self.transform = transform
+
+	def __len__(self):
+		return self.points.shape[0]
+
+	def __getitem__(self, index):
+		# sorted indices read the file front to back, the batch order is restored by the gather
+		index = np.asarray(index)
+		order = np.argsort(index)
+		batch = np.empty((len(index),) + self.points.shape[1:], dtype=np.float32)
+		batch[order] = self.points[index[order]]
+		batch = torch.from_numpy(batch)
+		if self.normalized:
+			batch.mul_(2).sub_(1) # [-1, 1]
+		if self.transform is not None:
+			batch = self.transform(batch)
+		return batch
+
+	def loader(self, batch_size, shuffle=True, drop_last=True, num_workers=0):
+		sampler = RandomSampler(self) if shuffle else SequentialSampler(self)
+		return DataLoader(self, batch_size=None, num_workers=num_workers,
+						sampler=BatchSampler(sampler, batch_size, drop_last))
+
+
 class Provider:
 
 	@staticmethod
@@ -28,12 +64,8 @@ class Provider:
 			# store
 			if mode_space > 1:
 				ind = np.argsort(seqs, axis=1)
-				sorted_data = np.zeros(points.shape)
-				for i in range(ind.shape[0]):
-					row = points[i, ind[i, :], :]
-					sorted_data[i, :, :] = row
-				fpath_m= os.path.join(dataset_path, 'hilbert_data_s{}.npy'.format(m))
-				np.save(fpath_m, sorted_data)
+				sorted_data = np.take_along_axis(points, ind[:, :, None], axis=1)
+				np.save(fpath_hilbert, sorted_data)
 			else:
 				sorted_data = np.sort(seqs, axis=1)
 				fpath_hilbert = os.path.join(dataset_path, 'hilbert_data_s1.npy')
@@ -41,6 +73,14 @@ class Provider:
 
 		return sorted_data
 
+	@staticmethod
+	def load_dataset(dataset_path, mode_space, m, p, normalized=False, renew=False, transform=None):
+		""" load_data as a memory-mapped PointCloudDataset, the hilbert-sorted file is built once """
+		fpath_hilbert = os.path.join(dataset_path, 'hilbert_data_s{}.npy'.format(mode_space))
+		if renew or not os.path.isfile(fpath_hilbert):
+			Provider.load_data(dataset_path, mode_space, m, p, renew=True)
+		return PointCloudDataset(fpath_hilbert, normalized=normalized, transform=transform)
+
 
 	@staticmethod
 	def load_mnist(dataset_path, normalized=False, renew=True):
@@ -49,7 +89,7 @@ class Provider:
 		fpath_hilbert = os.path.join(dataset_path, fname_hilbert)
 		if os.path.isfile(fpath_hilbert) and not(renew):
 			print('Load hilbert codes')
-			seqs = np.load(fpath_hilbert)
+			seqs = np.load(fpath_hilbert, mmap_mode='r')
 		else:
 			print("Load data")
 			fname_pc = 'data.npy'
@@ -60,10 +100,10 @@ class Provider:
 			# convert data to hilbertcode
 			seqs = SFC.encode_sfc(points)
 			np.save(fpath_hilbert, seqs)
-		# Tensor
+		# Tensor: a single float32 copy, normalized in place
+		tseqs = torch.from_numpy(np.array(seqs, dtype=np.float32))
 		if normalized:
-			seqs = seqs * 2 - 1 # [-1, 1]
-		tseqs = torch.Tensor(seqs)
+			tseqs.mul_(2).sub_(1) # [-1, 1]
 		return tseqs
 
 	@staticmethod
@@ -0,0 +1,125 @@
+"""
+	Rendering of point clouds and image grids to PNG files in a pool of worker processes
+"""
+import os
+import atexit
+import multiprocessing
+
+# one figure per kind of plot and worker, cleared between renders
+_figures = {}
+
+
+def _init_matplotlib():
+	""" in the worker, on its first render : idle workers import nothing """
+	import matplotlib
+	matplotlib.use('Agg')
+	# the ggplot style and font sizes Plotter sets at import
+	from . import plotter
+
+
+def _figure(kind):
+	if not _figures:
+		_init_matplotlib()
+	import matplotlib.pyplot as plt
+	if kind not in _figures:
+		fig = plt.figure(figsize=(4, 4) if kind == 'grid' else None)
+		if kind == '3d':
+			fig.add_subplot(111, projection='3d')
+		elif kind == '2d':
+			fig.add_subplot(111)
+		_figures[kind] = fig
+	return _figures[kind]
+
+
+def _render_pc(xs, filepath, color=False):
+	""" Plotter.plot_pc / plot_pc_color (last point in red) on a reused figure """
+	kind = '3d' if 3 == xs.shape[1] else '2d'
+	fig = _figure(kind)
+	ax = fig.axes[0]
+	ax.cla()
+	if color and kind == '3d':
+		ax.scatter(xs[:-1, 0], xs[:-1, 1], xs[:-1, 2], color='g')
+		ax.scatter(xs[-1, 0], xs[-1, 1], xs[-1, 2], color='r')
+	elif color:
+		ax.scatter(xs[:-1, 0], xs[:-1, 1], color='g')
+		ax.scatter(xs[-1, 0], xs[-1, 1], color='r')
+	elif kind == '3d':
+		ax.scatter(xs[:, 0], xs[:, 1], xs[:, 2])
+	else:
+		ax.scatter(xs[:, 0], xs[:, 1])
+	if kind == '3d':
+		ax.set_xlim([0, 1])
+		ax.set_ylim([0, 1])
+	fig.savefig(filepath, bbox_inches='tight')
+
+
+def _render_steps(xs, steps, pattern):
+	""" the first i + 1 points of xs for every i of steps, to pattern.format(i) """
+	for i in steps:
+		_render_pc(xs[:i + 1], pattern.format(i), color=True)
+
+
+def _render_grid(samples, im_size, filepath, n_fig_unit=2):
+	""" Plotter.save_images on a reused figure """
+	fig = _figure('grid')
+	import matplotlib.gridspec as gridspec
+	fig.clf()
+	gs = gridspec.GridSpec(n_fig_unit, n_fig_unit, figure=fig, wspace=0.05, hspace=0.05)
+	for i, sample in enumerate(samples):
+		ax = fig.add_subplot(gs[i])
+		ax.axis('off')
+		ax.set_aspect('equal')
+		ax.imshow(sample.reshape(im_size, im_size), cmap='Greys_r')
+	fig.savefig(filepath, bbox_inches='tight')
+
+
+class Renderer(object):
+	"""
+		renders on a pool of processes with the Agg backend, calls return at once and the PNG files
+		are written in the background. the pool is forked when the renderer is built, so build it
+		before any thread starts (AsyncWriter, Prefetcher, pin-memory threads) : forking a
+		multi-threaded process can deadlock on a lock another thread holds. fork, because spawn
+		and forkserver re-import scripts run as __main__. the workers only run matplotlib.
+		at most max_pending renders are queued, flush waits for them and re-raises their errors,
+		close (also run at exit) flushes and stops the pool. arrays must be numpy, not tensors
+	"""
+	def __init__(self, processes=None, max_pending=256, method='fork'):
+		self.processes = processes or max(1, (os.cpu_count() or 2) // 2)
+		self.max_pending = max_pending
+		self.pending = []
+		ctx = multiprocessing.get_context(method)
+		self.pool = ctx.Pool(self.processes)
+		atexit.register(self.close)
+
+	def submit(self, fn, *args):
+		if self.pool is None:
+			raise Exception('Renderer is closed')
+		# finished renders : re-raise a failure, then forget them
+		for r in [r for r in self.pending if r.ready()]:
+			r.get()
+			self.pending.remove(r)
+		while len(self.pending) >= self.max_pending:
+			self.pending.pop(0).get()
+		self.pending.append(self.pool.apply_async(fn, args))
+
+	def plot_pc(self, xs, filepath, color=False):
+		self.submit(_render_pc, xs, filepath, color)
+
+	def plot_pc_steps(self, xs, pattern, chunk=64):
+		""" one PNG per prefix xs[:i + 1] (last point in red), pattern.format(i), split in chunks """
+		for start in range(0, xs.shape[0], chunk):
+			self.submit(_render_steps, xs, range(start, min(start + chunk, xs.shape[0])), pattern)
+
+	def save_images(self, samples, im_size, filepath, n_fig_unit=2):
+		self.submit(_render_grid, samples, im_size, filepath, n_fig_unit)
+
+	def flush(self):
+		while len(self.pending) > 0:
+			self.pending.pop(0).get()
+
+	def close(self):
+		if self.pool is not None:
+			self.flush()
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
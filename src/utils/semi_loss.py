@@ -4,9 +4,8 @@
 ###Implementation of the paper [Genevay et al., 2016]: (https://arxiv.org/pdf/1605.08527.pdf)
 import torch
 import numpy as np
-import ot
-import matplotlib.pylab as pl
 import time
+from utils.sliced import sliced_wasserstein
 
 
 def coordinate_gradient(eps, nu, v, C, i):
@@ -71,8 +70,8 @@ def averaged_sgd_entropic_transport(epsilon, mu, nu, C, n_source, n_target, nb_i
         optimization vector
     '''
 
-    cur_v = torch.zeros(n_target).cuda()
-    ave_v = torch.zeros(n_target).cuda()
+    cur_v = C.new_zeros(n_target)
+    ave_v = C.new_zeros(n_target)
     for cur_iter in range(nb_iter):
         k = cur_iter + 1
         i = np.random.randint(n_source)
@@ -107,7 +106,7 @@ def c_transform_entropic(epsilon, nu, v, C, n_source, n_target):
     u : np.ndarray(ns,)
     '''
 
-    u = torch.zeros(n_source).cuda()
+    u = C.new_zeros(n_source)
     for i in range(n_source):
         r = C[i,:] - v
         exp_v = torch.exp(-r/epsilon) * nu
@@ -156,11 +155,14 @@ def perceptual_loss(loss_fn, im0, im1):
     d = loss_fn.forward(im0,im1)
     return d
 
-def semi_opt(nu_data, mu_data, px, loss_fn=None):
+def semi_opt(nu_data, mu_data, px, loss_fn=None, cost='lpips', n_projections=50):
     """
         nu_data [Nv, 1, 28, 28]: target discrete
         mu_data [Nu, 1, 28, 28]: source continuous
         mu [Nu, 30, 28, 28]: params of distributions
+        cost: 'lpips' entropic semi-dual OT with loss_fn as ground cost between every pair of images,
+              'sliced' sliced-Wasserstein distance between the px-weighted source images and the
+              target images (flattened), no pairwise costs and no ASGD iterations
     """
     eps = 1
     nb_iter = 10000
@@ -169,6 +171,12 @@ def semi_opt(nu_data, mu_data, px, loss_fn=None):
     # estimate mu, nu and c
     n_target = nu_data.shape[0]
     n_source = mu_data.shape[0]
+    if cost == 'sliced':
+        mu = px * (1./torch.sum(px))
+        return sliced_wasserstein(mu_data.reshape(1, n_source, -1), nu_data.reshape(1, n_target, -1),
+                                  n_projections, x_weights=mu.view(1, n_source))[0]
+    elif cost != 'lpips':
+        raise Exception('semi_opt cost {} not in [lpips, sliced]'.format(cost))
     _, C, H, W = mu_data.shape
     gap = (64 - W)//2
     p2d = (gap, gap, gap, gap)
@@ -181,8 +189,7 @@ def semi_opt(nu_data, mu_data, px, loss_fn=None):
     # [Nu]
     mu = px * (1./torch.sum(px))
     # [Nv]
-    nu = torch.ones(n_target) / n_target
-    nu = nu.cuda()
+    nu = px.new_ones(n_target) / n_target
 
     # calculate wasserstein distance
     asgd_pi, opt_v, opt_u = transportation_matrix_entropic(eps, mu, nu, c, n_source, n_target, nb_iter, lr)
@@ -191,6 +198,8 @@ def semi_opt(nu_data, mu_data, px, loss_fn=None):
     return w
 
 if __name__ == '__main__':
+    # POT is only the reference solver of this check
+    import ot
 #Constants
     n_source = 7
     n_target = 4
@@ -199,14 +208,14 @@ if __name__ == '__main__':
     lr = 0.1
 
 #Initialization
-    mu = torch.rand(n_source)
-    mu *= (1./np.sum(mu))
-    X_source = np.arange(n_source)
-    nu = np.random.random(n_target)
-    nu *= (1./np.sum(nu))
-    Y_target = np.arange(0, n_target)
-
-    c = np.abs(X_source[:, None] - Y_target[None, :])
+    mu = torch.rand(n_source, dtype=torch.float64)
+    mu *= (1./torch.sum(mu))
+    X_source = torch.arange(n_source, dtype=torch.float64)
+    nu = torch.rand(n_target, dtype=torch.float64)
+    nu *= (1./torch.sum(nu))
+    Y_target = torch.arange(0, n_target, dtype=torch.float64)
+
+    c = torch.abs(X_source[:, None] - Y_target[None, :])
     #print("The cost matrix is : \n", c)
 
 #Check Code
@@ -219,7 +228,7 @@ if __name__ == '__main__':
 
 ####TEST result from POT library
     start_sinkhorn = time.time()
-    sinkhorn_pi = ot.sinkhorn(mu, nu, c, 1)
+    sinkhorn_pi = torch.from_numpy(ot.sinkhorn(mu.numpy(), nu.numpy(), c.numpy(), 1))
     end_sinkhorn = time.time()
     print("According to sinkhorn and POT, the transportation matrix is : \n", sinkhorn_pi)
 
@@ -0,0 +1,47 @@
+"""
+	Latent codes of a frozen autoencoder, encoded once and memory-mapped
+"""
+import os
+import hashlib
+import numpy as np
+import torch
+
+
+def file_hash(path, block_size=2**20):
+	""" short sha1 of a file, e.g. an AE checkpoint """
+	sha1 = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			sha1.update(block)
+	return sha1.hexdigest()[:16]
+
+
+def cache_latent_codes(encode, loader, device, cache_dir, ae_path, name='latents', renew=False):
+	"""
+		encode: the frozen encoder, e.g. netV.encode
+		loader: the whole dataset in a fixed order, batches of inputs or (inputs, labels)
+		writes encode(x) for every sample as float32 [N, ...] to a .npy named after the hash of the
+		AE checkpoint at ae_path, so a retrained AE never reads stale codes, and returns its path.
+		the encoder runs only when that file does not exist yet (or renew)
+	"""
+	path = os.path.join(cache_dir, '{}_{}.npy'.format(name, file_hash(ae_path)))
+	if os.path.isfile(path) and not renew:
+		return path
+	print('Encode dataset to {}'.format(path))
+	tmp = path + '.tmp.npy'
+	codes, start = None, 0
+	with torch.no_grad():
+		for batch in loader:
+			if isinstance(batch, (list, tuple)):
+				batch = batch[0]
+			z = encode(batch.to(device)).float().cpu().numpy()
+			if codes is None:
+				codes = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+									shape=(len(loader.dataset),) + z.shape[1:])
+			codes[start:start + z.shape[0]] = z
+			start += z.shape[0]
+	assert start == codes.shape[0], 'the loader must cover the dataset once, without drop_last'
+	codes.flush()
+	del codes
+	os.replace(tmp, path)
+	return path
@@ -4,20 +4,260 @@
 	Training 2 signals together
 """
 import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from utils.helper import Helper
+from utils.sliced import sliced_wasserstein
 
 import torch
 import torch.autograd as autograd
+import torch.nn as nn
 import torch.nn.functional as F
 
-def chamfer_batch(a, b):
+def chamfer_batch(a, b, max_elements=2**24, backend='chunked'):
+	"""
+		a, b: [B, D, N] point clouds
+		sum over the batch of the squared chamfer distance, see ChamferDistance
+		backend: 'chunked' (exact O(N^2) search, any device) or 'kdtree' (O(N log N) on cpu, for
+		clouds of several thousand points), both give the same pairs up to ties
+	"""
 	a = torch.transpose(a, 1, 2).contiguous()
 	b = torch.transpose(b, 1, 2).contiguous()
+	return ChamferDistance.apply(a, b, max_elements, NEAREST_NEIGHBOURS[backend]).sum()
 
-	d = batch_pairwise_dist(a, b)
-	dx = torch.min(d, dim=2)[0].sum(dim=1)
-	dy = torch.min(d, dim=1)[0].sum(dim=1)
-	return (dx + dy).sum()
+def nearest_neighbours(x, y, max_elements=2**24):
+	"""
+		x: [B, N, D], y: [B, M, D]
+		index [B, N] of the nearest point of y for every point of x. squared distances are
+		computed for a chunk of rows of x at a time, [B, chunk, M] holds at most max_elements
+	"""
+	bs, num_points, _ = x.size()
+	chunk = max(1, max_elements // (bs * y.size(1)))
+	yy = (y * y).sum(dim=2).unsqueeze(1)
+	idx = []
+	for start in range(0, num_points, chunk):
+		xc = x[:, start:start + chunk]
+		d = torch.baddbmm(yy, xc, y.transpose(2, 1), alpha=-2)
+		idx.append(d.argmin(dim=2))
+	return torch.cat(idx, dim=1)
+
+def kdtree_neighbours(x, y, max_elements=None, workers=None):
+	"""
+		nearest_neighbours with one KD-tree per cloud of y. the clouds of the batch are built and
+		queried in parallel on a thread pool, cKDTree releases the GIL. max_elements is unused
+	"""
+	from scipy.spatial import cKDTree
+	xs = x.detach().cpu().numpy()
+	ys = y.detach().cpu().numpy()
+	query = lambda k: cKDTree(ys[k]).query(xs[k], k=1)[1]
+	with ThreadPoolExecutor(workers) as pool:
+		idx = list(pool.map(query, range(xs.shape[0])))
+	return torch.from_numpy(np.stack(idx).astype(np.int64)).to(x.device)
+
+NEAREST_NEIGHBOURS = {'chunked': nearest_neighbours, 'kdtree': kdtree_neighbours}
+
+def gather_points(y, idx):
+	""" y: [B, M, D], idx: [B, N] -> [B, N, D] """
+	return y.gather(1, idx.unsqueeze(2).expand(-1, -1, y.size(2)))
+
+class ChamferDistance(autograd.Function):
+	"""
+		x: [B, N, D], y: [B, M, D] -> [B] sum of squared distances from every point to its nearest
+		neighbour in the other cloud. the nearest neighbours are searched in chunks (nearest_neighbours)
+		and backward only keeps their indices, never a [B, N, M] matrix. the |x_i|^2 term is constant
+		per row so it is left out of the argmin
+	"""
+	@staticmethod
+	def forward(ctx, x, y, max_elements=2**24, search=nearest_neighbours):
+		with torch.no_grad():
+			idx_x = search(x, y, max_elements)
+			idx_y = search(y, x, max_elements)
+			dx = (x - gather_points(y, idx_x)).pow(2).sum(dim=2)
+			dy = (y - gather_points(x, idx_y)).pow(2).sum(dim=2)
+		ctx.save_for_backward(x, y, idx_x, idx_y)
+		return dx.sum(dim=1) + dy.sum(dim=1)
+
+	@staticmethod
+	def backward(ctx, grad):
+		x, y, idx_x, idx_y = ctx.saved_tensors
+		g = 2 * grad.view(-1, 1, 1)
+		diff_x = g * (x - gather_points(y, idx_x))
+		diff_y = g * (y - gather_points(x, idx_y))
+		grad_x = diff_x.scatter_add(1, idx_y.unsqueeze(2).expand_as(diff_y), -diff_y)
+		grad_y = diff_y.scatter_add(1, idx_x.unsqueeze(2).expand_as(diff_x), -diff_x)
+		return grad_x, grad_y, None, None
+
+def squared_distances(x, y):
+	"""
+		x: [B, N, D], y: [B, M, D] -> [B, N, M], as |x|^2 + |y|^2 - 2 x.y so that neither the
+		forward nor autograd hold a [B, N, M, D] difference tensor
+	"""
+	xx = (x * x).sum(dim=2).unsqueeze(2)
+	yy = (y * y).sum(dim=2).unsqueeze(1)
+	# cancellation can leave tiny negative values
+	return torch.baddbmm(xx + yy, x, y.transpose(2, 1), alpha=-2).clamp(min=0)
+
+def hungarian_matching(C, workers=None):
+	"""
+		C: [B, N, N] costs -> [B, N] index of the point of y matched to every point of x by an
+		optimal assignment, one scipy linear_sum_assignment per cloud on a thread pool
+	"""
+	from scipy.optimize import linear_sum_assignment
+	costs = C.detach().cpu().numpy()
+	match = lambda k: linear_sum_assignment(costs[k])[1]
+	with ThreadPoolExecutor(workers) as pool:
+		idx = list(pool.map(match, range(costs.shape[0])))
+	return torch.from_numpy(np.stack(idx).astype(np.int64)).to(C.device)
+
+def sinkhorn_plan(C, eps=1e-3, iters=20, scaling=0.5):
+	"""
+		C: [B, N, M] costs -> [B, N, M] entropic transport plan between uniform weights, total mass 1.
+		log-domain updates of the dual potentials, epsilon starts at the largest cost and is
+		multiplied by scaling down to eps * largest cost, iters iterations per value
+	"""
+	bs, n, m = C.size()
+	C = C.detach()
+	cmax = C.max().item()
+	log_a, log_b = -np.log(n), -np.log(m)
+	f = C.new_zeros(bs, n)
+	g = C.new_zeros(bs, m)
+	e = cmax
+	while True:
+		e = max(e * scaling, eps * cmax)
+		for _ in range(iters):
+			f = -e * torch.logsumexp((g.unsqueeze(1) - C) / e + log_b, dim=2)
+			g = -e * torch.logsumexp((f.unsqueeze(2) - C) / e + log_a, dim=1)
+		if e <= eps * cmax:
+			break
+	return torch.exp((f.unsqueeze(2) + g.unsqueeze(1) - C) / e + log_a + log_b)
+
+class EmdDistance(nn.Module):
+	"""
+		earth mover's distance between point clouds x, y: [B, N, D] with the same number of points,
+		per cloud [B]: mean squared distance between transported points
+		mode: 'exact' optimal one-to-one matching (hungarian_matching), for small N
+			'sinkhorn' entropic approximation (sinkhorn_plan), batched on any device
+		eps, iters: the time / accuracy knob of 'sinkhorn', the final regularisation relative to the
+			largest cost and the iterations per epsilon, smaller eps / more iters is closer to exact
+		gradients flow through the costs of the plan, the plan itself is held constant (its
+		derivative does not change the optimal cost)
+	"""
+	def __init__(self, mode='sinkhorn', eps=1e-3, iters=20, scaling=0.5, workers=None):
+		super(EmdDistance, self).__init__()
+		if mode not in ['exact', 'sinkhorn']:
+			raise Exception('EmdDistance mode {} not in [exact, sinkhorn]'.format(mode))
+		self.mode = mode
+		self.eps = eps
+		self.iters = iters
+		self.scaling = scaling
+		self.workers = workers
+
+	def forward(self, x, y):
+		assert x.size(1) == y.size(1), 'EmdDistance needs clouds with the same number of points'
+		C = squared_distances(x, y)
+		if self.mode == 'exact':
+			idx = hungarian_matching(C, self.workers)
+			return C.gather(2, idx.unsqueeze(2)).mean(dim=(1, 2))
+		P = sinkhorn_plan(C, self.eps, self.iters, self.scaling)
+		return (P * C).sum(dim=(1, 2))
+
+def hilbert_keys(x, y, bits=10):
+	"""
+		x: [B, N, D], y: [B, M, D] -> int64 Hilbert curve indices [B, N], [B, M] of the points
+		on a grid of 2^bits cells per axis spanning the bounding box of both clouds.
+		Skilling's axes-to-transpose algorithm, vectorised over the points, D * bits < 63
+	"""
+	lo = torch.min(x.min(dim=1)[0], y.min(dim=1)[0]).unsqueeze(1)
+	hi = torch.max(x.max(dim=1)[0], y.max(dim=1)[0]).unsqueeze(1)
+	scale = (hi - lo).max(dim=2, keepdim=True)[0].clamp(min=1e-12)
+	keys = []
+	for v in [x, y]:
+		q = ((v - lo) / scale * (2 ** bits - 1)).round().long()
+		X = [q[:, :, i] for i in range(q.size(2))]
+		n = len(X)
+		Q = 1 << (bits - 1)
+		while Q > 1:
+			P = Q - 1
+			for i in range(n):
+				high = (X[i] & Q) != 0
+				if i == 0:
+					X[0] = torch.where(high, X[0] ^ P, X[0])
+				else:
+					t = (X[0] ^ X[i]) & P
+					X[0], X[i] = torch.where(high, X[0] ^ P, X[0] ^ t), torch.where(high, X[i], X[i] ^ t)
+			Q >>= 1
+		for i in range(1, n):
+			X[i] = X[i] ^ X[i - 1]
+		t = torch.zeros_like(X[0])
+		Q = 1 << (bits - 1)
+		while Q > 1:
+			t = torch.where((X[n - 1] & Q) != 0, t ^ (Q - 1), t)
+			Q >>= 1
+		X = [Xi ^ t for Xi in X]
+		h = torch.zeros_like(X[0])
+		for j in range(bits - 1, -1, -1):
+			for i in range(n):
+				h = (h << 1) | ((X[i] >> j) & 1)
+		keys.append(h)
+	return keys[0], keys[1]
+
+def refine_matching(x, y, perm, window=8, passes=1):
+	"""
+		x, y: [B, N, D], perm: [B, N] point of y matched to every point of x, x ordered along the
+		curve. swaps the partners of two points of x less than window apart whenever that lowers
+		the sum of squared distances, each (shift, offset) round compares disjoint pairs at once
+	"""
+	num_points = x.size(1)
+	for _ in range(passes):
+		for shift in range(1, min(window, num_points)):
+			for offset in [0, shift]:
+				k = torch.arange(offset, num_points - shift, device=x.device)
+				k = k[((k - offset) // shift) % 2 == 0]
+				if len(k) == 0:
+					continue
+				xa, xb = x[:, k], x[:, k + shift]
+				ya, yb = gather_points(y, perm[:, k]), gather_points(y, perm[:, k + shift])
+				current = (xa - ya).pow(2).sum(dim=2) + (xb - yb).pow(2).sum(dim=2)
+				swapped = (xa - yb).pow(2).sum(dim=2) + (xb - ya).pow(2).sum(dim=2)
+				swap = swapped < current
+				pa, pb = perm[:, k], perm[:, k + shift]
+				perm[:, k] = torch.where(swap, pb, pa)
+				perm[:, k + shift] = torch.where(swap, pa, pb)
+	return perm
+
+def hilbert_emd(x, y, bits=10, window=0, passes=1):
+	"""
+		approximate EmdDistance in O(N log N): x: [B, N, D], y: [B, N, D] -> [B] mean squared
+		distance between the points of equal rank along a Hilbert curve, optionally improved by
+		refine_matching over windows of that many neighbours along the curve (0 = off).
+		gradients flow through the costs of the matched pairs
+	"""
+	assert x.size(1) == y.size(1), 'hilbert_emd needs clouds with the same number of points'
+	with torch.no_grad():
+		kx, ky = hilbert_keys(x, y, bits)
+		order_x = kx.argsort(dim=1)
+		perm = ky.argsort(dim=1)
+		if window > 1:
+			perm = refine_matching(gather_points(x, order_x), y, perm, window, passes)
+	return (gather_points(x, order_x) - gather_points(y, perm)).pow(2).sum(dim=2).mean(dim=1)
+
+POINT_CLOUD_LOSSES = ['emd', 'emd_exact', 'chamfer', 'chamfer_kdtree', 'sliced', 'hilbert']
+
+def point_cloud_loss(name, n_projections=50):
+	""" loss_fn(x, y) between clouds [B, N, D] -> [B], one of POINT_CLOUD_LOSSES """
+	if name == 'emd':
+		return EmdDistance('sinkhorn')
+	elif name == 'emd_exact':
+		return EmdDistance('exact')
+	elif name == 'chamfer':
+		return lambda x, y: ChamferDistance.apply(x.contiguous(), y.contiguous())
+	elif name == 'chamfer_kdtree':
+		return lambda x, y: ChamferDistance.apply(x.contiguous(), y.contiguous(), None, kdtree_neighbours)
+	elif name == 'sliced':
+		return lambda x, y: sliced_wasserstein(x, y, n_projections)
+	elif name == 'hilbert':
+		return lambda x, y: hilbert_emd(x, y, window=8)
+	raise Exception('point cloud loss {} not in {}'.format(name, POINT_CLOUD_LOSSES))
 
 def log_prob_from_logits(x):
     """ numerically stable log_softmax implementation that prevents overflow """
@@ -102,8 +342,43 @@ def batch_pairwise_dist(x, y):
 	xx = torch.bmm(x, x.transpose(2,1))
 	yy = torch.bmm(y, y.transpose(2,1))
 	zz = torch.bmm(x, y.transpose(2,1))
-	diag_ind = torch.arange(0, num_points).type(torch.cuda.LongTensor)
+	diag_ind = torch.arange(0, num_points, device=x.device)
 	rx = xx[:, diag_ind, diag_ind].unsqueeze(1).expand_as(xx)
 	ry = yy[:, diag_ind, diag_ind].unsqueeze(1).expand_as(yy)
 	P = (rx.transpose(2,1) + ry - 2*zz)
 	return P
+
+
+if __name__ == '__main__':
+	# chunked chamfer against the full pairwise matrix, values and gradients
+	torch.manual_seed(0)
+	a = torch.rand(4, 3, 300, dtype=torch.float64, requires_grad=True)
+	b = torch.rand(4, 3, 200, dtype=torch.float64, requires_grad=True)
+	loss = chamfer_batch(a, b, max_elements=4 * 200 * 7)
+	ga, gb = autograd.grad(loss, [a, b])
+	x, y = a.transpose(1, 2), b.transpose(1, 2)
+	d = (x.unsqueeze(2) - y.unsqueeze(1)).pow(2).sum(dim=3)
+	ref = d.min(dim=2)[0].sum() + d.min(dim=1)[0].sum()
+	ra, rb = autograd.grad(ref, [a, b])
+	print('chamfer', loss.item(), ref.item())
+	assert torch.allclose(loss, ref) and torch.allclose(ga, ra) and torch.allclose(gb, rb)
+	loss = chamfer_batch(a, b, backend='kdtree')
+	ga, gb = autograd.grad(loss, [a, b])
+	print('chamfer kdtree', loss.item())
+	assert torch.allclose(loss, ref) and torch.allclose(ga, ra) and torch.allclose(gb, rb)
+
+	# sinkhorn emd approaches the exact matching as eps goes down
+	x = torch.rand(4, 64, 3, dtype=torch.float64)
+	y = torch.rand(4, 64, 3, dtype=torch.float64)
+	assert torch.allclose(squared_distances(x, y), (x.unsqueeze(2) - y.unsqueeze(1)).pow(2).sum(dim=3))
+	exact = EmdDistance('exact')(x, y)
+	for eps in [1e-2, 1e-3, 1e-4]:
+		approx = EmdDistance('sinkhorn', eps=eps, iters=100)(x, y)
+		print('emd eps {} : {}, exact {}'.format(eps, approx.tolist(), exact.tolist()))
+	assert torch.allclose(approx, exact, rtol=5e-2)
+
+	# hilbert rank matching is a valid matching : never below exact, refinement only lowers it
+	rank = hilbert_emd(x, y)
+	refined = hilbert_emd(x, y, window=8, passes=2)
+	print('hilbert emd : {}, refined {}'.format(rank.tolist(), refined.tolist()))
+	assert (refined <= rank + 1e-12).all() and (exact <= refined + 1e-12).all()